@@ -1,67 +1,560 @@
 # -*- coding: utf-8 -*-
 # K-Pg
 import os
-from datetime import datetime
+import argparse
+from contextlib import contextmanager
+from datetime import timedelta
+import json
 import logging
-
-import pylast
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import Queue
+import threading
+import time
 
 from shiva import models as m
 from shiva.app import app, db
-from shiva.utils import ID3Manager
+from shiva.lastfm import LastFM, ResponseCache
+from shiva.mpeg import MPEGError, read_seek_table
+from shiva.utils import TrackInfo
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 q = db.session.query
 logger = logging.getLogger()
 
+# Number of paths handed to each worker at once when indexing in parallel.
+CHUNK_SIZE = 16
+# Maximum number of bound parameters in a single IN clause. SQLite's limit is
+# 999.
+IN_CLAUSE_SIZE = 500
+# Number of tracks written to the database in a single transaction.
+BATCH_SIZE = 500
+# Files read by the device scanners and waiting to be written. When full, the
+# scanners wait for the writer.
+SCAN_QUEUE_SIZE = 1024
+# Seconds between progress lines.
+PROGRESS_INTERVAL = 10
+# Tags a track can't be stored without.
+TAG_FIELDS = ('artist', 'album', 'title')
+# Filesystem events the watch mode listens to.
+if pyinotify:
+    WATCH_MASK = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE |
+                  pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+                  pyinotify.IN_MOVED_TO)
+
+
+def read_track(file_path):
+    """Worker entry point for the parallel indexer. Parses the tags of the
+    given file and returns a (TrackInfo, seconds) tuple. The TrackInfo is None
+    if the file is not a valid track.
+    """
+    start = time.time()
+    try:
+        info = TrackInfo.load(file_path)
+    except Exception, e:
+        logger.error('Could not read %s: %s' % (file_path, e))
+        info = None
+
+    return (info, time.time() - start)
+
+
+def read_track_seek_table(track):
+    """Worker entry point for building seek tables. Takes a (pk, path) tuple
+    and returns a (pk, table, seconds) one. The table is empty if the file is
+    not an MPEG stream, and None if it couldn't be read.
+    """
+    pk, file_path = track
+    start = time.time()
+    try:
+        table = read_seek_table(file_path)
+    except MPEGError:
+        table = ''
+    except (IOError, OSError), e:
+        logger.error('Could not read %s: %s' % (file_path, e))
+        table = None
+
+    return (pk, table, time.time() - start)
+
+
+class Metrics(object):
+    """
+    Counters, and the number of calls and time spent on each stage of the
+    indexing. Stages running on several threads or processes add up their
+    time, so it can exceed the duration of the run.
+
+    It's safe to share an instance between threads.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        # stage: [calls, seconds]
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def time(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start)
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            timer = self.stages.setdefault(stage, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def get(self, counter):
+        return self.counters.get(counter, 0)
+
+    def summary(self):
+        with self.lock:
+            return {
+                'elapsed': round(time.time() - self.start, 3),
+                'counters': dict(self.counters),
+                'stages': dict((stage, {
+                    'calls': calls,
+                    'seconds': round(seconds, 6),
+                }) for stage, (calls, seconds) in self.stages.iteritems()),
+            }
+
 
 class Indexer(object):
-    def __init__(self, config=None):
+    def __init__(self, config=None, jobs=1, incremental=False,
+                 batch_size=BATCH_SIZE, lastfm=True, interactive=True):
         self.config = config
         self.media_dirs = config.get('MEDIA_DIRS', [])
+        self.jobs = max(jobs, 1)
+        self.incremental = incremental
+        self.batch_size = max(batch_size, 1)
+        self.use_lastfm = lastfm
+        self.interactive = interactive
         self.id3r = None
+        # path: (size, mtime, inode) of the files indexed on previous runs.
+        self.manifest = {}
+        # (size, mtime, inode): path, to recognise the files that were moved.
+        self.stat_paths = {}
+        # (old path, new path) of the moves found by the walk.
+        self.moves = []
+        # path: stat result of the new and modified files found on this run.
+        self.stats = {}
+        self.seen = set()
+        self.scanned_dirs = []
+        # Rows waiting to be bulk inserted on the next flush(), and the paths
+        # of those tracks, which the database doesn't know about yet.
+        self.new_tracks = []
+        self.new_paths = set()
+        self.new_files = []
+        self.new_links = []
+        self.batch_count = 0
+        self.batch_start = time.time()
+        self.total_count = 0
+        # name: pk caches, and the (album_pk, artist_pk) pairs already linked.
+        self.artists = {}
+        self.albums = {}
+        self.album_artists = set()
+        # pks of the artists and albums of the tracks saved since the last
+        # enrich(), which watch mode limits the lookups to.
+        self.changed_artists = set()
+        self.changed_albums = set()
+        # Paths of the files waiting in the pending_files table.
+        self.pending = set()
+        # Fingerprints of the tracks, a hit means a move or a duplicate.
+        self.fingerprints = set()
         self.PREV_ARTIST = None
         self.PREV_ALBUM = None
-        self.lastfm = pylast.LastFMNetwork(api_key=config['LASTFM_API_KEY'])
+        self.lastfm = None
+        self.metrics = Metrics()
+        self.scanning = False
+        self.last_progress = time.time()
 
         if len(self.media_dirs) == 0:
             logger.error('Remember to set the MEDIA_DIRS setting, otherwise I '
                          'don\'t know where to look for.')
 
+    def load_caches(self):
+        """Reads the name and pk of every artist and album into memory, so
+        resolving the ones of each track is a dictionary lookup.
+        """
+
+        self.artists = dict(q(m.Artist.name, m.Artist.pk))
+        self.albums = dict(q(m.Album.name, m.Album.pk))
+        self.album_artists = set(q(m.artists.c.album_pk,
+                                   m.artists.c.artist_pk))
+        self.pending = set(path.encode('utf-8')
+                           for path, in q(m.PendingFile.path))
+        self.fingerprints = set(fp for fp, in q(m.Track.fingerprint).filter(
+            m.Track.fingerprint != None))
+
     def get_artist(self, name):
+        """Returns the pk of the artist with the given name, creating it if it
+        doesn't exist.
+        """
+
+        if name in self.artists:
+            return self.artists[name]
+
         artist = q(m.Artist).filter_by(name=name).first()
         if not artist:
-            cover = self.lastfm.get_artist(name).get_cover_image()
-            artist = m.Artist(name=name, image=cover)
+            artist = m.Artist(name=name)
+            m.slugs.reserve(m.Artist, [artist], 'name')
             db.session.add(artist)
+            db.session.flush()
+
+        self.artists[name] = artist.pk
+
+        return artist.pk
+
+    def get_album(self, name):
+        """Returns the pk of the album with the given name, creating it if it
+        doesn't exist.
+        """
+
+        if name in self.albums:
+            return self.albums[name]
+
+        album = q(m.Album).filter_by(name=name).first()
+        if not album:
+            album = m.Album(name=name,
+                            year=self.get_id3_reader().release_year)
+            m.slugs.reserve(m.Album, [album], 'name')
+            db.session.add(album)
+            db.session.flush()
+
+        self.albums[name] = album.pk
+
+        return album.pk
+
+    def link(self, album_pk, artist_pk):
+        """Queues the relation between an album and an artist, unless it
+        already exists.
+        """
+
+        if (album_pk, artist_pk) in self.album_artists:
+            return False
+
+        self.album_artists.add((album_pk, artist_pk))
+        self.new_links.append({'album_pk': album_pk, 'artist_pk': artist_pk})
+
+        return True
+
+    def get_lastfm(self):
+        if not self.lastfm:
+            cache = ResponseCache(self.config['LASTFM_CACHE_PATH'],
+                                  self.config['LASTFM_CACHE_TTL'],
+                                  self.config['LASTFM_CACHE_MISS_TTL'])
+            self.lastfm = LastFM(self.config['LASTFM_API_KEY'],
+                                 url=self.config['LASTFM_API_URL'],
+                                 cache=cache)
+
+        return self.lastfm
+
+    def fetch_artist(self, artist):
+        pk, name = artist
+
+        return (pk, self.get_lastfm().get_artist_image(name))
+
+    def fetch_album(self, album):
+        pk, name, artist_name = album
+
+        return (pk, self.get_lastfm().get_album_info(artist_name, name))
+
+    def enrich(self, changed_only=False):
+        """Fetches the missing artist images, album covers and release years
+        from Last.fm. This runs as a separate stage once the tracks are
+        stored, so indexing never waits on the network. Requests are made by a
+        pool of LASTFM_WORKERS threads, while this thread writes the results.
+
+        With changed_only, only the artists and albums of the tracks saved
+        since the last call are looked at, as watch mode does after each
+        batch of changes.
+        """
+
+        artist_pks, self.changed_artists = self.changed_artists, set()
+        album_pks, self.changed_albums = self.changed_albums, set()
+
+        if not self.config.get('LASTFM_API_KEY'):
+            logger.warning('LASTFM_API_KEY is not set, skipping Last.fm.')
+            return False
+
+        artist_query = q(m.Artist.pk, m.Artist.name).filter(
+            m.Artist.image == None)
+        album_query = q(m.Album.pk, m.Album.name, m.Artist.name).join(
+            m.Album.artists).filter(m.Album.cover == None)
+        if changed_only:
+            artist_pks, album_pks = list(artist_pks), list(album_pks)
+            artists, rows = [], []
+            for i in xrange(0, len(artist_pks), IN_CLAUSE_SIZE):
+                artists.extend(artist_query.filter(
+                    m.Artist.pk.in_(artist_pks[i:i + IN_CLAUSE_SIZE])))
+            for i in xrange(0, len(album_pks), IN_CLAUSE_SIZE):
+                rows.extend(album_query.filter(
+                    m.Album.pk.in_(album_pks[i:i + IN_CLAUSE_SIZE])))
+        else:
+            artists, rows = artist_query.all(), album_query
+
+        albums = {}
+        for pk, name, artist_name in rows:
+            albums.setdefault(pk, (pk, name, artist_name))
+
+        if not artists and not albums:
+            return True
+
+        self.get_lastfm()
+
+        pool = ThreadPool(self.config.get('LASTFM_WORKERS', 4))
+        start = time.time()
+        try:
+            count = 0
+            for pk, image in pool.imap_unordered(self.fetch_artist, artists):
+                if image:
+                    q(m.Artist).filter_by(pk=pk).update({'image': image})
+                    count += 1
+
+            for pk, (cover, year) in pool.imap_unordered(self.fetch_album,
+                                                         albums.values()):
+                values = {}
+                if cover:
+                    values['cover'] = cover
+                if year:
+                    values['year'] = year
+                if values:
+                    q(m.Album).filter_by(pk=pk).update(values)
+                    count += 1
+
+            if count:
+                m.bump_revision()
+            db.session.commit()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            self.lastfm.cache.close()
+            self.lastfm = None
+            self.metrics.add_time('enrich', time.time() - start)
+
+        self.metrics.count('enriched', count)
+        logger.info('Enriched %i of %i artists and albums.' % (
+            count, len(artists) + len(albums)))
+
+        return True
+
+    def build_seek_tables(self):
+        """Builds the seek tables of the tracks lacking one, those whose file
+        has no Xing TOC. That means reading the whole file, so it runs as a
+        separate stage once the tracks are stored, in a pool of worker
+        processes when there are several jobs. Files that couldn't be read
+        are tried again on the next run.
+        """
+
+        query = q(m.Track.pk, m.Track.path).filter(m.Track.seek_table == None)
+        tracks = [(pk, path.encode('utf-8')) for pk, path in query]
+        if not tracks:
+            return 0
 
-        return artist
+        pool = multiprocessing.Pool(self.jobs) if self.jobs > 1 else None
+        if pool:
+            results = pool.imap_unordered(read_track_seek_table, tracks,
+                                          CHUNK_SIZE)
+        else:
+            results = (read_track_seek_table(track) for track in tracks)
+
+        count = 0
+        try:
+            for pk, table, seconds in results:
+                self.metrics.add_time('seek_table', seconds)
+                if table is None:
+                    continue
+
+                q(m.Track).filter_by(pk=pk).update({'seek_table': table},
+                                                   synchronize_session=False)
+                count += 1
+                if count % self.batch_size == 0:
+                    db.session.commit()
+            db.session.commit()
 
-    def get_release_year(self, lastfm_album):
-        _date = lastfm_album.get_release_date()
-        if not _date:
-            if not self.get_id3_reader().release_year:
-                return None
+            if pool:
+                pool.close()
+        except:
+            if pool:
+                pool.terminate()
+            raise
+        finally:
+            if pool:
+                pool.join()
 
-            return self.get_id3_reader().release_year
+        self.metrics.count('seek_tables', count)
+        logger.info('Built %i of %i seek tables.' % (count, len(tracks)))
 
-        return datetime.strptime(_date, '%d %b %Y, %H:%M').year
+        return count
 
     def save_track(self):
         """Takes a path to a track, reads its metadata and stores everything in
         the database.
         """
-        session = db.session
         full_path = self.file_path.decode('utf-8')
 
-        logger.info(self.file_path)
+        logger.debug(self.file_path)
+        self.metrics.count('processed')
+        self.report_progress()
 
-        if q(m.Track).filter_by(path=full_path).count():
+        if full_path in self.new_paths:
+            # Found twice before the flush, e.g. by overlapping MediaDirs.
             return True
 
-        track = m.Track(full_path)
+        with self.metrics.time('lookup'):
+            track = q(m.Track).filter_by(path=full_path).first()
+        if track and not self.incremental:
+            return True
 
-        use_prev = None
+        # Files to be deferred are left before looking for a move, otherwise a
+        # moved track would also be pending.
         id3r = self.get_id3_reader()
+        complete = all(getattr(id3r, field) for field in TAG_FIELDS)
+        if not complete and not self.interactive:
+            return self.defer(id3r)
+
+        if not track:
+            with self.metrics.time('lookup'):
+                track = self.find_moved_track(id3r)
+
+        if not complete:
+            self.ask(id3r)
+
+        if track:
+            # The file was modified since it was indexed.
+            track.read_metadata(id3r)
+        else:
+            track = m.Track(full_path, id3r=id3r)
+
+        with self.metrics.time('lookup'):
+            artist_pk = self.get_artist(id3r.artist)
+            album_pk = self.get_album(id3r.album)
+        self.link(album_pk, artist_pk)
+        self.changed_artists.add(artist_pk)
+        self.changed_albums.add(album_pk)
+
+        track.album_pk = album_pk
+        track.artist_pk = artist_pk
+        if not track.pk:
+            self.add_track(track)
+
+        if self.incremental:
+            self.update_manifest(self.file_path)
+
+        if self.file_path in self.pending:
+            self.pending.remove(self.file_path)
+            q(m.PendingFile).filter_by(path=full_path).delete()
+
+        self.metrics.count('saved')
+        self.batch_count += 1
+        if self.batch_count >= self.batch_size:
+            self.flush()
+
+        return True
+
+    def find_moved_track(self, id3r):
+        """Looks for an indexed track with the same fingerprint as the current
+        file whose file is gone. If there is one the file was moved, and the
+        track is pointed to the new path and returned, keeping its pk and
+        lyrics. Tracks whose files still exist are only reported as
+        duplicates.
+        """
+
+        if not id3r.fingerprint or id3r.fingerprint not in self.fingerprints:
+            return None
+
+        query = q(m.Track).filter_by(fingerprint=id3r.fingerprint)
+        for track in query:
+            old_path = track.get_path()
+            if os.path.exists(old_path):
+                logger.info('%s is a duplicate of %s' % (self.file_path,
+                                                         old_path))
+                self.metrics.count('duplicates')
+                continue
+
+            self.move_track(old_path, self.file_path)
+
+            return track
+
+        return None
+
+    def move_track(self, old_path, new_path):
+        """Moves the track, manifest entry and queued tag edits of a file to
+        its new path.
+        """
+
+        logger.info('%s moved to %s' % (old_path, new_path))
+        self.metrics.count('moved')
+
+        old, new = old_path.decode('utf-8'), new_path.decode('utf-8')
+        for model in (m.Track, m.IndexedFile, m.TagEdit):
+            q(model).filter_by(path=old).update({'path': new})
+
+        _stat = self.manifest.pop(old_path, None)
+        if _stat:
+            self.manifest[new_path] = _stat
+
+    def apply_moves(self):
+        """Applies the moves found by the walk. The files aren't read, as
+        their content didn't change.
+        """
+
+        moves, self.moves = self.moves, []
+        for old_path, new_path in moves:
+            self.move_track(old_path, new_path)
+            self.update_manifest(new_path)
+        if moves:
+            m.bump_revision()
+        db.session.commit()
+
+        if moves:
+            logger.info('%i tracks moved.' % len(moves))
+
+    def find_duplicates(self):
+        """Returns the paths of the tracks that share a fingerprint, as a list
+        of groups of paths.
+        """
+
+        shared = q(m.Track.fingerprint).filter(
+            m.Track.fingerprint != None).group_by(m.Track.fingerprint).having(
+            db.func.count(m.Track.pk) > 1)
+        query = q(m.Track.fingerprint, m.Track.path).filter(
+            m.Track.fingerprint.in_(shared.subquery())).order_by(
+            m.Track.fingerprint, m.Track.path)
+
+        groups = {}
+        for fp, path in query:
+            groups.setdefault(fp, []).append(path.encode('utf-8'))
+
+        return sorted(groups.values())
+
+    def ask(self, id3r):
+        """Prompts the user for the missing artist, album and title of a
+        track. The answers are queued to be written to the file's tags.
+        """
+
+        missing = [field for field in TAG_FIELDS if not getattr(id3r, field)]
+
+        use_prev = None
         if not id3r.artist:
             _prev = self.PREV_ARTIST
             if _prev:
@@ -89,77 +582,735 @@ class Indexer(object):
             self.PREV_ALBUM = _album
             id3r.album = _album
 
-        artist = self.get_artist(id3r.artist)
+        if not id3r.title:
+            id3r.title = raw_input('Song title: ').decode('utf-8').strip()
 
-        album = q(m.Album).filter_by(name=id3r.album).first()
-        if not album:
-            _album = self.lastfm.get_album(self.lastfm.get_artist(artist.name),
-                                           id3r.album)
-            album = m.Album(name=id3r.album,
-                            year=self.get_release_year(_album))
-            album.cover = _album.get_cover_image(size=pylast.COVER_EXTRA_LARGE)
+        self.queue_tag_edits(dict((field, getattr(id3r, field))
+                                  for field in missing))
 
-        if artist not in album.artists:
-            album.artists.append(artist)
+    def queue_tag_edits(self, values):
+        """Queues changes to the tags of the current file. Nothing is written
+        to the file now, tagger.py applies them later.
+        """
+
+        path = self.file_path.decode('utf-8')
+        for field, value in values.iteritems():
+            if not value:
+                continue
 
-        session.add(album)
+            q(m.TagEdit).filter_by(path=path, field=field).delete()
+            db.session.add(m.TagEdit(path=path, field=field, value=value))
 
-        track.album = album
-        track.artist = artist
-        session.add(track)
+    def defer(self, id3r):
+        """Records a file with incomplete tags in the pending_files table
+        instead of asking the user, so the scan can go on. Returns False, as
+        the track was not saved.
+        """
 
-        session.commit()
+        logger.warning('Incomplete tags, deferring %s' % self.file_path)
+        self.metrics.count('deferred')
 
-        return True
+        values = dict((field, getattr(id3r, field) or None)
+                      for field in TAG_FIELDS)
+        if self.file_path in self.pending:
+            q(m.PendingFile).filter_by(
+                path=self.file_path.decode('utf-8')).update(values)
+        else:
+            db.session.add(m.PendingFile(path=self.file_path.decode('utf-8'),
+                                         **values))
+            self.pending.add(self.file_path)
+
+        return False
+
+    def resolve(self, path, artist=None, album=None, title=None,
+                title_from_filename=False):
+        """Stores the pending files found under the given path, completing
+        their missing tags with the values given now or on previous calls.
+        When title_from_filename is set, missing titles are taken from the
+        file name.
+
+        Returns the number of tracks saved. Files that remain incomplete stay
+        pending.
+        """
+
+        self.interactive = False
+        self.incremental = True
+        self.load_caches()
+        self.load_manifest()
+
+        query = m.PendingFile.under(path)
+        pending = [(p.get_path(), p.artist, p.album, p.title) for p in query]
+
+        count = 0
+        for file_path, _artist, _album, _title in pending:
+            self.file_path = file_path
+            try:
+                info = TrackInfo.load(file_path)
+            except Exception, e:
+                logger.error('Could not read %s: %s' % (file_path, e))
+                continue
+
+            missing = [field for field in TAG_FIELDS
+                       if not getattr(info, field)]
+            info.artist = info.artist or _artist or artist
+            info.album = info.album or _album or album
+            info.title = info.title or _title or title
+            if not info.title and title_from_filename:
+                name = os.path.splitext(os.path.basename(file_path))[0]
+                info.title = name.decode('utf-8').strip()
+            self.queue_tag_edits(dict((field, getattr(info, field))
+                                      for field in missing))
+
+            self.id3r = info
+            self.stats[file_path] = self.stat(file_path)
+            if self.save_track():
+                count += 1
+        self.flush()
+
+        return count
+
+    def add_track(self, track):
+        """Queues a new track to be bulk inserted on the next flush. The track
+        is never added to the session.
+        """
+
+        self.new_tracks.append(dict((c.name, getattr(track, c.name))
+                                    for c in m.Track.__table__.columns
+                                    if c.name != 'pk'))
+        self.new_paths.add(track.path)
+        if track.fingerprint:
+            self.fingerprints.add(track.fingerprint)
+
+    def flush(self):
+        """Writes everything pending in a single transaction and empties the
+        session, so memory usage doesn't grow with the size of the library.
+        """
+
+        session = db.session
+        with self.metrics.time('flush'):
+            if self.new_tracks:
+                m.slugs.reserve(m.Track, self.new_tracks, 'title')
+                session.execute(m.Track.__table__.insert(), self.new_tracks)
+            if self.new_files:
+                session.execute(m.IndexedFile.__table__.insert(),
+                                self.new_files)
+            if self.new_links:
+                session.execute(m.artists.insert(), self.new_links)
+            if self.batch_count or self.new_links:
+                m.bump_revision()
+            session.commit()
+            session.expunge_all()
+
+        elapsed = time.time() - self.batch_start
+        if self.batch_count:
+            logger.info('Wrote %i tracks (%.1f rows/s).' % (
+                self.batch_count, self.batch_count / max(elapsed, 0.001)))
+
+        self.total_count += self.batch_count
+        self.new_tracks = []
+        self.new_paths = set()
+        self.new_files = []
+        self.new_links = []
+        self.batch_count = 0
+        self.batch_start = time.time()
 
     def get_id3_reader(self):
         if not self.id3r or not self.id3r.same_path(self.file_path):
-            self.id3r = ID3Manager(self.file_path)
+            with self.metrics.time('parse'):
+                self.id3r = TrackInfo.load(self.file_path)
 
         return self.id3r
 
+    def is_accepted(self, file_path):
+        """Checks the extension of a file against the ACCEPTED_FORMATS setting.
+        """
+        if '.' not in file_path:
+            return False
+
+        ext = file_path[file_path.rfind('.') + 1:]
+
+        return ext in self.config.get('ACCEPTED_FORMATS', [])
+
     def is_track(self):
         """Tries to guess whether the file is a valid track or not.
         """
+        if not self.is_accepted(self.file_path):
+            return False
+
         if os.path.isdir(self.file_path):
             return False
 
-        if '.' not in self.file_path:
+        if not self.get_id3_reader().is_valid():
             return False
 
-        ext = self.file_path[self.file_path.rfind('.') + 1:]
-        if ext not in self.config.get('ACCEPTED_FORMATS', []):
+        return True
+
+    def get_devices(self):
+        """Groups the directories to scan by the device they live on, as a
+        {st_dev: [directories]} dictionary.
+        """
+
+        devices = {}
+        for mdir in self.get_dirs():
+            try:
+                device = os.stat(mdir).st_dev
+            except OSError, e:
+                logger.error(e)
+                continue
+
+            devices.setdefault(device, []).append(mdir)
+
+        return devices
+
+    def get_device_jobs(self, device):
+        """Returns the number of threads reading files from a device, see the
+        SCAN_DEVICE_JOBS setting.
+        """
+
+        for path, jobs in self.config.get('SCAN_DEVICE_JOBS', {}).iteritems():
+            try:
+                if os.stat(path).st_dev == device:
+                    return max(jobs, 1)
+            except OSError:
+                continue
+
+        return max(self.config.get('SCAN_JOBS_PER_DEVICE', 2), 1)
+
+    def scan_device(self, device, dirs, results, read=True):
+        """Walks the directories of a device, putting the files found in the
+        results queue. When read is set the files are put as TrackInfo
+        objects, read by the device's own pool of threads. A None is put at
+        the end, whatever happens.
+        """
+
+        pool = None
+        try:
+            paths = (path for mdir in dirs for path in self.find_changed(mdir))
+            if not read:
+                for path in paths:
+                    results.put(path)
+            else:
+                pool = ThreadPool(self.get_device_jobs(device))
+                for info, seconds in pool.imap_unordered(read_track, paths,
+                                                         CHUNK_SIZE):
+                    self.add_parse_time(info, seconds)
+                    if info:
+                        results.put(info)
+
+            if pool:
+                pool.close()
+        except Exception, e:
+            logger.error('Scan of %s failed: %s' % (', '.join(dirs), e))
+            if pool:
+                pool.terminate()
+        finally:
+            if pool:
+                pool.join()
+            results.put(None)
+
+    def scan(self, read=True):
+        """Scans every device at the same time, each one with its own walker,
+        so a slow disk or mount doesn't hold back the others. Yields the
+        files found, as TrackInfo objects when read is set, or as paths.
+        """
+
+        results = Queue.Queue(SCAN_QUEUE_SIZE)
+        scanners = []
+        for device, dirs in self.get_devices().iteritems():
+            scanner = threading.Thread(target=self.scan_device,
+                                       args=(device, dirs, results, read))
+            scanner.daemon = True
+            scanner.start()
+            scanners.append(scanner)
+
+        running = len(scanners)
+        self.scanning = True
+        while running:
+            # A timeout keeps the wait interruptible.
+            try:
+                item = results.get(timeout=1)
+            except Queue.Empty:
+                continue
+
+            if item is None:
+                running -= 1
+            else:
+                yield item
+        self.scanning = False
+
+    def add_parse_time(self, info, seconds):
+        self.metrics.add_time('parse', seconds)
+        if not info:
+            self.metrics.count('errors')
+
+    def report_progress(self, force=False):
+        """Logs the number of files processed, their rate and the estimated
+        time left, at most every PROGRESS_INTERVAL seconds. The estimate only
+        counts the files found so far while the directories are being walked.
+        """
+
+        now = time.time()
+        if not force and now - self.last_progress < PROGRESS_INTERVAL:
             return False
 
-        if not self.get_id3_reader().is_valid():
+        self.last_progress = now
+        done = self.metrics.get('processed') + self.metrics.get('errors')
+        total = self.metrics.get('changed')
+        rate = done / max(now - self.metrics.start, 0.001)
+        eta = timedelta(seconds=int((total - done) / rate)) if rate else '?'
+        logger.info('%i/%i files, %.1f files/s, ETA %s%s' % (
+            done, total, rate, eta, ' (still walking)' if self.scanning
+            else ''))
+
+        return True
+
+    def list_dir(self, dir_name):
+        """Returns (path, is_dir) tuples for the entries of a directory. With
+        scandir the type comes from the same readdir call, without stat'ing
+        every entry.
+        """
+
+        if scandir:
+            return [(entry.path, entry.is_dir())
+                    for entry in scandir(dir_name)]
+
+        paths = (os.path.join(dir_name, name)
+                 for name in os.listdir(dir_name))
+
+        return [(path, os.path.isdir(path)) for path in paths]
+
+    def find_files(self, dir_name):
+        """Walks through a directory yielding the path of every file with an
+        accepted extension. Extensions are checked before anything is opened,
+        the files are validated later. The walk is iterative, so deep trees
+        can't hit the recursion limit.
+        """
+
+        if not os.path.isdir(dir_name):
+            if self.is_accepted(dir_name):
+                yield dir_name
+            return
+
+        pending = [dir_name]
+        while pending:
+            try:
+                with self.metrics.time('walk'):
+                    entries = self.list_dir(pending.pop())
+            except OSError, e:
+                logger.error(e)
+                continue
+
+            subdirs = []
+            for path, is_dir in entries:
+                if is_dir:
+                    subdirs.append(path)
+                elif self.is_accepted(path):
+                    yield path
+
+            # Keeps the depth-first order of a recursive walk.
+            pending.extend(reversed(subdirs))
+
+    def find_changed(self, dir_name):
+        """Like find_files(), but in incremental mode skips the files whose
+        size, mtime and inode match the ones stored in the manifest.
+        """
+
+        for file_path in self.find_files(dir_name):
+            self.metrics.count('found')
+            if not self.incremental:
+                self.metrics.count('changed')
+                yield file_path
+                continue
+
+            self.seen.add(file_path)
+            if self.has_changed(file_path) and not self.is_moved(file_path):
+                self.metrics.count('changed')
+                yield file_path
+
+    def has_changed(self, file_path):
+        """Compares the stat information of a file with the one in the
+        manifest, keeping it for update_manifest() if they differ.
+        """
+
+        _stat = self.stat(file_path)
+        if not _stat or self.manifest.get(file_path) == _stat:
             return False
 
+        self.stats[file_path] = _stat
+
         return True
 
-    def walk(self, dir_name):
-        """Recursively walks through a directory looking for tracks.
+    def is_moved(self, file_path):
+        """Checks whether a new file is an indexed one that was renamed or
+        moved within the same filesystem, i.e. its size, mtime and inode are
+        the ones of a file that is gone. The move is queued for
+        apply_moves(). Files moved across filesystems are caught later by
+        their fingerprint.
         """
 
-        if os.path.isdir(dir_name):
-            for name in os.listdir(dir_name):
-                self.file_path = os.path.join(dir_name, name)
-                if os.path.isdir(self.file_path):
-                    self.walk(self.file_path)
-                else:
-                    if self.is_track():
-                        self.save_track()
-        else:
-            self.file_path = dir_name
-            if self.is_track():
-                self.save_track()
+        if file_path in self.manifest:
+            return False
+
+        old_path = self.stat_paths.get(self.stats[file_path])
+        if (not old_path or old_path not in self.manifest or
+                os.path.exists(old_path)):
+            return False
+
+        self.moves.append((old_path, file_path))
 
         return True
 
-    def run(self):
+    def stat(self, file_path):
+        """Returns the (size, mtime, inode) tuple stored in the manifest, or
+        None if the file can't be accessed. The mtime is in microseconds, so
+        it survives databases without double precision floats.
+        """
+
+        try:
+            with self.metrics.time('stat'):
+                stat = os.stat(file_path)
+        except OSError:
+            return None
+
+        return (stat.st_size, int(stat.st_mtime * 1000000), stat.st_ino)
+
+    def get_dirs(self):
+        """Yields the directories of the MEDIA_DIRS, and keeps the ones that
+        exist in scanned_dirs, for prune().
+        """
+
+        self.scanned_dirs = []
         for mobject in self.media_dirs:
             for mdir in mobject.get_dirs():
-                self.walk(mdir)
+                if os.path.exists(mdir):
+                    self.scanned_dirs.append(os.path.join(mdir, ''))
+
+                yield mdir
+
+    def load_manifest(self):
+        """Reads the stat information of every indexed file into memory.
+        """
+
+        query = q(m.IndexedFile.path, m.IndexedFile.size,
+                  m.IndexedFile.mtime, m.IndexedFile.inode)
+        for path, size, mtime, inode in query:
+            self.manifest[path.encode('utf-8')] = (size, mtime, inode)
+        self.stat_paths = dict((_stat, path)
+                               for path, _stat in self.manifest.iteritems())
+
+        logger.info('%i files in the manifest.' % len(self.manifest))
+
+    def update_manifest(self, file_path):
+        """Stores the stat information of a file that was just indexed. New
+        entries are inserted on the next flush().
+        """
+
+        _stat = self.stats.pop(file_path, None)
+        if not _stat:
+            return False
+
+        size, mtime, inode = _stat
+        path = file_path.decode('utf-8')
+        if file_path in self.manifest:
+            q(m.IndexedFile).filter_by(path=path).update({
+                'size': size,
+                'mtime': mtime,
+                'inode': inode,
+            })
+        else:
+            self.new_files.append({
+                'path': path,
+                'size': size,
+                'mtime': mtime,
+                'inode': inode,
+            })
+        self.manifest[file_path] = _stat
+        self.stat_paths[_stat] = file_path
+
+        return True
+
+    def prune(self):
+        """Deletes the tracks whose files disappeared. Files living in a
+        directory that couldn't be scanned (e.g. an unmounted disk) are left
+        alone.
+        """
+
+        missing = []
+        for file_path in self.manifest:
+            if file_path in self.seen:
+                continue
+
+            if not any(file_path.startswith(d) for d in self.scanned_dirs):
+                continue
+
+            if not os.path.exists(file_path):
+                missing.append(file_path)
+
+        self.delete_tracks(missing)
+
+    def delete_tracks(self, file_paths):
+        """Deletes the tracks, lyrics and manifest entries of the given
+        files.
+        """
+
+        missing = [file_path.decode('utf-8') for file_path in file_paths]
+        for i in xrange(0, len(missing), IN_CLAUSE_SIZE):
+            paths = missing[i:i + IN_CLAUSE_SIZE]
+            pks = [pk for pk, in q(m.Track.pk).filter(m.Track.path.in_(paths))]
+            if pks:
+                q(m.Lyrics).filter(m.Lyrics.track_pk.in_(pks)).delete(
+                    synchronize_session=False)
+                q(m.Track).filter(m.Track.pk.in_(pks)).delete(
+                    synchronize_session=False)
+                m.bump_revision()
+            q(m.IndexedFile).filter(m.IndexedFile.path.in_(paths)).delete(
+                synchronize_session=False)
+            q(m.PendingFile).filter(m.PendingFile.path.in_(paths)).delete(
+                synchronize_session=False)
+            db.session.commit()
+
+        for file_path in file_paths:
+            self.manifest.pop(file_path, None)
+            self.pending.discard(file_path)
+
+        self.metrics.count('removed', len(missing))
+        logger.info('%i tracks removed.' % len(missing))
+
+    def watch(self):
+        """Keeps the database in sync with the MEDIA_DIRS by listening to
+        filesystem events instead of scanning. Events are coalesced, and
+        applied once no new one arrived for WATCH_DELAY seconds, or at most
+        WATCH_MAX_DELAY seconds after the first one.
+
+        Runs until interrupted. Requires pyinotify.
+        """
+
+        if not pyinotify:
+            logger.error('The watch mode requires pyinotify.')
+            return False
+
+        self.interactive = False
+        self.incremental = True
+        self.load_caches()
+        self.load_manifest()
+
+        # path: action, the last event for a path wins.
+        self.changes = {}
+        self.first_change = self.last_change = 0
+        self.watch_manager = pyinotify.WatchManager()
+        for mdir in self.get_dirs():
+            if os.path.isdir(mdir):
+                self.watch_manager.add_watch(mdir, WATCH_MASK, rec=True,
+                                             auto_add=True)
+
+        delay = self.config.get('WATCH_DELAY', 2)
+        max_delay = self.config.get('WATCH_MAX_DELAY', 30)
+        notifier = pyinotify.Notifier(self.watch_manager, self.on_event)
+        logger.info('Watching for changes.')
+        try:
+            while True:
+                if notifier.check_events(timeout=int(delay * 1000)):
+                    notifier.read_events()
+                    notifier.process_events()
+
+                if not self.changes:
+                    continue
+
+                now = time.time()
+                if (now - self.last_change >= delay or
+                        now - self.first_change >= max_delay):
+                    self.apply_changes()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            notifier.stop()
+
+        return True
+
+    def on_event(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            # Events were lost, the only way to catch up is a scan.
+            logger.warning('Event queue overflow, rescanning.')
+            action, path = 'scan', None
+        elif event.dir:
+            if event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+                action = 'delete_dir'
+            else:
+                action = 'scan'
+                if event.mask & pyinotify.IN_MOVED_TO:
+                    # Moved in from outside the watched directories.
+                    self.watch_manager.add_watch(event.pathname, WATCH_MASK,
+                                                 rec=True, auto_add=True)
+            path = event.pathname
+        else:
+            # Wait for IN_CLOSE_WRITE, the file may be half written.
+            if event.mask & pyinotify.IN_CREATE:
+                return
+            if not self.is_accepted(event.pathname):
+                return
+            if event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+                action = 'delete'
+            else:
+                action = 'update'
+            path = event.pathname
+
+        self.last_change = time.time()
+        if not self.changes:
+            self.first_change = self.last_change
+        self.changes[path] = action
+
+    def apply_changes(self):
+        """Indexes, updates or removes the paths affected by the events
+        received since the last call.
+        """
+
+        changes, self.changes = self.changes, {}
+        logger.info('Applying %i changes.' % len(changes))
+
+        # New files go first, so the moved ones are found before their old
+        # paths are deleted.
+        for path, action in changes.iteritems():
+            if path is None:
+                paths = (_path for mdir in self.get_dirs()
+                         for _path in self.find_changed(mdir))
+            elif action == 'scan':
+                paths = self.find_changed(path)
+            elif (action == 'update' and self.has_changed(path) and
+                    not self.is_moved(path)):
+                paths = (path,)
+            else:
+                continue
+
+            for file_path in paths:
+                self.file_path = file_path
+                try:
+                    if not self.is_track():
+                        continue
+                except Exception, e:
+                    logger.error('Could not read %s: %s' % (file_path, e))
+                    continue
+
+                self.save_track()
+        self.flush()
+        self.apply_moves()
+
+        deleted = []
+        for path, action in changes.iteritems():
+            if action == 'delete':
+                deleted.append(path)
+            elif action == 'delete_dir':
+                prefix = os.path.join(path, '').decode('utf-8')
+                query = q(m.Track.path).filter(m.Track.path.startswith(prefix))
+                deleted.extend(_path.encode('utf-8') for _path, in query)
+        self.delete_tracks(set(deleted))
+        self.build_seek_tables()
+
+        if self.use_lastfm:
+            self.enrich(changed_only=True)
+
+    def run(self):
+        self.load_caches()
+        if self.incremental:
+            self.load_manifest()
+
+        start = time.time()
+        if self.jobs > 1:
+            self.run_parallel()
+        else:
+            for info in self.scan():
+                self.file_path = info.path
+                self.id3r = info
+                self.save_track()
+        self.flush()
+        self.apply_moves()
+
+        elapsed = max(time.time() - start, 0.001)
+        logger.info('Indexed %i tracks in %.1fs (%.1f rows/s).' % (
+            self.total_count, elapsed, self.total_count / elapsed))
+
+        self.report_progress(force=True)
+
+        if self.incremental:
+            self.prune()
+
+        self.build_seek_tables()
+
+        if self.use_lastfm:
+            self.enrich()
+
+        summary = self.metrics.summary()
+        logger.info('Summary: %s' % json.dumps(summary, sort_keys=True))
+
+        return summary
+
+    def run_parallel(self):
+        """Discovers files and parses their tags in a pool of worker
+        processes, while this process is the only one writing to the database.
+        The devices are still walked at the same time.
+        """
+
+        paths = self.scan(read=False)
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            for info, seconds in pool.imap_unordered(read_track, paths,
+                                                     CHUNK_SIZE):
+                self.add_parse_time(info, seconds)
+                if not info:
+                    continue
+
+                self.file_path = info.path
+                self.id3r = info
+                self.save_track()
+
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
 if __name__ == '__main__':
-    lola = Indexer(app.config)
-    lola.run()
+    parser = argparse.ArgumentParser(description='Indexes the MEDIA_DIRS.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes parsing tags and '
+                             'building seek tables in parallel.')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Only index new and modified files, and remove '
+                             'the tracks whose files are gone.')
+    parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE,
+                        help='Number of tracks written per transaction.')
+    parser.add_argument('--no-lastfm', action='store_true',
+                        help="Don't fetch images and covers from Last.fm.")
+    parser.add_argument('--headless', action='store_true',
+                        help='Never prompt. Files with incomplete tags are '
+                             'left pending, see resolver.py.')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Keep running, indexing the changes as they '
+                             'happen. Implies --headless.')
+    parser.add_argument('-d', '--duplicates', action='store_true',
+                        help='List the tracks with the same audio content.')
+    parser.add_argument('-s', '--summary', metavar='FILE',
+                        help='Write the counters and time spent on each stage '
+                             'to FILE, as JSON.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every file indexed.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    lola = Indexer(app.config, jobs=args.jobs, incremental=args.incremental,
+                   batch_size=args.batch_size, lastfm=not args.no_lastfm,
+                   interactive=not args.headless)
+    if args.duplicates:
+        for paths in lola.find_duplicates():
+            print '\n'.join(paths)
+            print
+    elif args.watch:
+        lola.watch()
+    else:
+        summary = lola.run()
+        if args.summary:
+            with open(args.summary, 'w') as f:
+                json.dump(summary, f, indent=4, separators=(',', ': '),
+                          sort_keys=True)
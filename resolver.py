@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Completes the files that the indexer left pending when running with
+--headless, e.g.:
+
+    $ python resolver.py --list
+    $ python resolver.py /srv/music/nofx --artist NOFX --album 'Ribbed'
+"""
+import argparse
+import logging
+
+from shiva import models as m
+from shiva.app import app
+from indexer import Indexer
+
+logger = logging.getLogger()
+
+
+def list_pending(path=None):
+    query = m.PendingFile.under(path).order_by(m.PendingFile.path)
+
+    for pending in query:
+        missing = [field for field in ('artist', 'album', 'title')
+                   if not getattr(pending, field)]
+        print '%s (missing %s)' % (pending.get_path(), ', '.join(missing))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Stores the files the indexer left pending.')
+    parser.add_argument('path', nargs='?', default='',
+                        help='Only resolve the files under this path.')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='List the pending files and what they lack.')
+    parser.add_argument('--artist', help='Artist for the files lacking one.')
+    parser.add_argument('--album', help='Album for the files lacking one.')
+    parser.add_argument('--title', help='Title for the files lacking one.')
+    parser.add_argument('--title-from-filename', action='store_true',
+                        help='Use the file name as title when missing.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every file stored.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.list:
+        list_pending(args.path)
+    else:
+        def _decode(value):
+            return value.decode('utf-8') if value else value
+
+        lola = Indexer(app.config, lastfm=False)
+        count = lola.resolve(args.path, artist=_decode(args.artist),
+                             album=_decode(args.album),
+                             title=_decode(args.title),
+                             title_from_filename=args.title_from_filename)
+        logger.info('%i tracks stored.' % count)
@@ -14,6 +14,11 @@ db.init_app(app)
 # URIs
 app.add_url_rule('/track/<int:track_id>/download.<ext>', 'download',
                  views.download)
+app.add_url_rule('/track/<int:track_id>/stream', 'stream', views.stream)
+app.add_url_rule('/album/<int:album_id>/download.<ext>', 'download_album',
+                 views.download_album)
+app.add_url_rule('/artist/<int:artist_id>/download.<ext>', 'download_artist',
+                 views.download_artist)
 
 # RESTful API
 api = Api(app)
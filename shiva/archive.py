@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Writes ZIP archives as a stream, without seeking or holding the files in
+memory. Entries are stored, not compressed (MP3s don't get any smaller), and
+the CRC of each one goes in a data descriptor right after its data. Since
+nothing is compressed, the size of the archive is known before writing it.
+
+ZIP64 records are only written when offsets don't fit in 32 bits.
+"""
+import logging
+import struct
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from a file at a time.
+CHUNK_SIZE = 64 * 1024
+# Offsets and counts from which ZIP64 records are needed.
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+# Size from which files can't be archived, as sizes aren't written in ZIP64.
+FILE_SIZE_LIMIT = 0xFFFFFFFF
+# Data descriptor (bit 3) and UTF-8 names (bit 11).
+FLAGS = 0x0808
+# Made by Unix, version 2.0 (4.5 with ZIP64).
+VERSION = 20
+VERSION_ZIP64 = 45
+MADE_BY = 3 << 8
+# Regular file, rw-r--r--.
+EXTERNAL_ATTR = 0100644 << 16
+
+LOCAL_HEADER = struct.Struct('<I5H3I2H')
+DATA_DESCRIPTOR = struct.Struct('<4I')
+CENTRAL_HEADER = struct.Struct('<I6H3I5HII')
+ZIP64_EXTRA = struct.Struct('<2HQ')
+ZIP64_END = struct.Struct('<IQ2H2I4Q')
+ZIP64_LOCATOR = struct.Struct('<2IQI')
+END = struct.Struct('<I4H2IH')
+
+
+def dos_time(mtime):
+    """Returns the (time, date) of a timestamp, as MS-DOS stores them."""
+
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return (0, (1 << 5) | 1)
+
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec / 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class Archive(object):
+    """
+    A ZIP archive of files, given as (name, path, size, mtime) tuples. The
+    sizes are trusted: a file that shrank or vanished since is padded with
+    zeros, so the archive is always `size` bytes long. Iterating over it
+    yields the archive.
+
+    """
+
+    def __init__(self, files):
+        self.entries = []
+        offset = 0
+        for name, path, size, mtime in files:
+            if size >= FILE_SIZE_LIMIT:
+                raise ValueError('%s is too big to be archived.' % path)
+
+            name = name.encode('utf-8')
+            self.entries.append((name, path, size, dos_time(mtime), offset))
+            offset += (LOCAL_HEADER.size + len(name) + size +
+                       DATA_DESCRIPTOR.size)
+
+        self.directory_offset = offset
+        self.directory_size = sum(
+            CENTRAL_HEADER.size + len(name) +
+            (ZIP64_EXTRA.size if offset >= ZIP64_LIMIT else 0)
+            for name, path, size, mtime, offset in self.entries)
+        self.zip64 = (self.directory_offset >= ZIP64_LIMIT or
+                      self.directory_size >= ZIP64_LIMIT or
+                      len(self.entries) >= ZIP64_COUNT_LIMIT)
+
+        self.size = self.directory_offset + self.directory_size + END.size
+        if self.zip64:
+            self.size += ZIP64_END.size + ZIP64_LOCATOR.size
+
+    def __iter__(self):
+        crcs = []
+        for name, path, size, (_time, date), offset in self.entries:
+            yield LOCAL_HEADER.pack(0x04034b50, VERSION, FLAGS, 0, _time, date,
+                                    0, size, size, len(name), 0) + name
+
+            crc = 0
+            for chunk in self.read(path, size):
+                crc = zlib.crc32(chunk, crc)
+                yield chunk
+
+            crc &= 0xFFFFFFFF
+            crcs.append(crc)
+            yield DATA_DESCRIPTOR.pack(0x08074b50, crc, size, size)
+
+        for (name, path, size, (_time, date), offset), crc in zip(
+                self.entries, crcs):
+            extra = ''
+            version = VERSION
+            if offset >= ZIP64_LIMIT:
+                extra = ZIP64_EXTRA.pack(1, 8, offset)
+                version = VERSION_ZIP64
+                offset = 0xFFFFFFFF
+            yield CENTRAL_HEADER.pack(
+                0x02014b50, MADE_BY | version, version, FLAGS, 0, _time, date,
+                crc, size, size, len(name), len(extra), 0, 0, 0,
+                EXTERNAL_ATTR, offset) + name + extra
+
+        count = len(self.entries)
+        directory_size, directory_offset = (self.directory_size,
+                                            self.directory_offset)
+        if self.zip64:
+            end_offset = directory_offset + directory_size
+            yield ZIP64_END.pack(
+                0x06064b50, ZIP64_END.size - 12, MADE_BY | VERSION_ZIP64,
+                VERSION_ZIP64, 0, 0, count, count, directory_size,
+                directory_offset) + \
+                ZIP64_LOCATOR.pack(0x07064b50, 0, end_offset, 1)
+            if count >= ZIP64_COUNT_LIMIT:
+                count = 0xFFFF
+            if directory_size >= ZIP64_LIMIT:
+                directory_size = 0xFFFFFFFF
+            if directory_offset >= ZIP64_LIMIT:
+                directory_offset = 0xFFFFFFFF
+
+        yield END.pack(0x06054b50, 0, 0, count, count, directory_size,
+                       directory_offset, 0)
+
+    def read(self, path, size):
+        """Yields exactly `size` bytes of a file, padded if needed."""
+
+        remaining = size
+        try:
+            with open(path, 'rb') as f:
+                while remaining > 0:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+
+                    remaining -= len(chunk)
+                    yield chunk
+        except IOError, e:
+            logger.error('Could not read %s: %s' % (path, e))
+
+        if remaining:
+            logger.error('%s is %i bytes shorter than expected.' % (
+                path, remaining))
+        while remaining > 0:
+            chunk = '\x00' * min(CHUNK_SIZE, remaining)
+            remaining -= len(chunk)
+            yield chunk
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Caches the API's responses until the library changes, as told by its revision
+(see shiva.models.Revision). Every response gets a strong ETag and a
+Last-Modified header, so clients can revalidate them for free.
+"""
+import calendar
+from collections import OrderedDict
+from functools import wraps
+from hashlib import sha1
+import threading
+
+from flask import request, Response, current_app as app
+from flask.ext.restful.representations.json import output_json
+from flask.ext.restful.utils import unpack
+from werkzeug.http import http_date
+
+from shiva.models import get_revision
+
+
+class LRUCache(object):
+    """
+    Keeps up to `size` bytes of responses, evicting the least recently used
+    ones first.
+
+    It's safe to share an instance between threads.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.revision = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, revision, key):
+        with self.lock:
+            if revision != self.revision:
+                # Nothing cached is valid anymore.
+                self.entries.clear()
+                self.used = 0
+                self.revision = revision
+
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+
+            return entry
+
+    def set(self, revision, key, body, headers):
+        if len(body) > self.size:
+            return False
+
+        with self.lock:
+            if revision != self.revision:
+                return False
+
+            if key in self.entries:
+                self.used -= len(self.entries.pop(key)[0])
+
+            while self.entries and self.used + len(body) > self.size:
+                self.used -= len(self.entries.popitem(last=False)[1][0])
+
+            self.entries[key] = (body, headers)
+            self.used += len(body)
+
+        return True
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+
+    if _cache is None:
+        _cache = LRUCache(app.config.get('RESPONSE_CACHE_SIZE', 0))
+
+    return _cache
+
+
+def get_key():
+    """The URL, with the query string sorted."""
+
+    args = '&'.join('%s=%s' % arg
+                    for arg in sorted(request.args.items(multi=True)))
+
+    return ('%s?%s' % (request.base_url, args)).encode('utf-8')
+
+
+def cached(method):
+    """
+    Decorator for the GET method of a Resource. Answers 304 when the client
+    has the current version of the response, and serves it from the cache
+    when possible.
+
+    """
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return method(*args, **kwargs)
+
+        number, modified = get_revision()
+        key = get_key()
+        headers = {
+            'ETag': '"%s"' % sha1('%i:%s' % (number, key)).hexdigest(),
+            'Last-Modified': http_date(modified),
+        }
+
+        if 'If-None-Match' in request.headers:
+            fresh = request.if_none_match.contains_weak(
+                headers['ETag'].strip('"'))
+        else:
+            since = request.if_modified_since
+            fresh = since and modified <= calendar.timegm(since.timetuple())
+        if fresh:
+            return Response(status=304, headers=headers.items())
+
+        cache = get_cache()
+        entry = cache.get(number, key)
+        if entry:
+            body, _headers = entry
+
+            return Response(body, mimetype='application/json',
+                            headers=_headers)
+
+        response = method(*args, **kwargs)
+        if not isinstance(response, Response):
+            data, code, _headers = unpack(response)
+            response = output_json(data, code, _headers)
+            # output_json() leaves Flask's default, text/html.
+            response.mimetype = 'application/json'
+
+        response.headers.extend(headers)
+        if response.status_code == 200 and not response.is_streamed:
+            cache.set(number, key, response.data, response.headers.items())
+
+        return response
+
+    return wrapper
@@ -5,3 +5,41 @@ SQLALCHEMY_DATABASE_URI = 'sqlite:///shiva.db'
 ACCEPTED_FORMATS = (
     'mp3',
 )
+
+# Last.fm responses are cached on disk. Artists and albums Last.fm doesn't know
+# are asked for again after LASTFM_CACHE_MISS_TTL seconds.
+LASTFM_API_URL = 'http://ws.audioscrobbler.com/2.0/'
+LASTFM_CACHE_PATH = 'lastfm.db'
+LASTFM_CACHE_TTL = 60 * 60 * 24 * 30
+LASTFM_CACHE_MISS_TTL = 60 * 60 * 24
+LASTFM_WORKERS = 4
+
+# The indexer's watch mode applies changes once no filesystem event arrived for
+# WATCH_DELAY seconds, or WATCH_MAX_DELAY seconds after the first one.
+WATCH_DELAY = 2
+WATCH_MAX_DELAY = 30
+
+# The indexer scans every device at the same time, reading each one's files
+# with SCAN_JOBS_PER_DEVICE threads. Spinning disks do best with 1, SSDs and
+# network mounts with more. SCAN_DEVICE_JOBS overrides it per device, as
+# {path on the device: threads}.
+SCAN_JOBS_PER_DEVICE = 2
+SCAN_DEVICE_JOBS = {}
+
+# Maximum bytes of API responses kept in memory. They are served until the
+# library changes.
+RESPONSE_CACHE_SIZE = 32 * 1024 * 1024
+
+# Let a front proxy send the downloaded files: 'X-Sendfile' (Apache, lighttpd)
+# or 'X-Accel-Redirect' (nginx), which gets DOWNLOAD_ACCEL_PREFIX prepended to
+# the path of the file, to match an internal location.
+DOWNLOAD_OFFLOAD = None
+DOWNLOAD_ACCEL_PREFIX = '/protected'
+
+# Tracks are transcoded on demand by TRANSCODE_ENCODER (ffmpeg, or a
+# compatible command) to any of TRANSCODE_BITRATES. Finished renditions are
+# kept in TRANSCODE_CACHE_PATH, up to TRANSCODE_CACHE_SIZE bytes.
+TRANSCODE_ENCODER = 'ffmpeg'
+TRANSCODE_BITRATES = (64, 96, 128, 192, 256, 320)
+TRANSCODE_CACHE_PATH = 'transcodes'
+TRANSCODE_CACHE_SIZE = 1024 * 1024 * 1024
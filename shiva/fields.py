@@ -1,6 +1,122 @@
 # -*- coding: utf-8 -*-
+from collections import namedtuple, OrderedDict
+
 from flask.ext.restful import fields, marshal
-from flask import current_app as app, request
+from flask import request
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.attributes import set_committed_value
+
+from shiva.media import get_router
+from shiva.models import IN_CLAUSE_SIZE
+
+
+def prefetch(objects, resource_fields):
+    """Loads the related objects of a list of model instances before
+    marshalling them, with a query per relation field instead of one per
+    instance. Returns the list.
+    """
+
+    if not objects:
+        return objects
+
+    for key, field in resource_fields.iteritems():
+        if isinstance(field, (ManyToManyField, ForeignKeyField)):
+            field.prefetch(key, objects)
+
+    return objects
+
+
+def chunks(values):
+    values = list(values)
+    for i in xrange(0, len(values), IN_CLAUSE_SIZE):
+        yield values[i:i + IN_CLAUSE_SIZE]
+
+
+# Stands for a related object when only its primary key is serialized.
+Key = namedtuple('Key', 'pk')
+
+
+class Serializer(object):
+    """
+    A resource_fields dictionary compiled once into a function per field, so
+    an object is serialized in a single pass without working out how to
+    output every field again, as marshal() does. The output is the same as
+    marshal()'s.
+
+    Every field also tells the columns it reads, or None if it needs the
+    object itself. When they are all columns of the model, from_rows is set:
+    select() then turns a query of instances into a query of plain rows that
+    the serializer takes as well, so no ORM object is built or related.
+
+    """
+
+    def __init__(self, resource_fields, model=None):
+        self.resource_fields = resource_fields
+        self.model = model
+        self.getters = []
+        self.columns = set()
+        for key, field in resource_fields.iteritems():
+            getter, columns = compile_field(key, field)
+            self.getters.append((key, getter))
+            if columns is None or self.columns is None:
+                self.columns = None
+            else:
+                self.columns.update(columns)
+
+        self.from_rows = bool(
+            model is not None and self.columns is not None and
+            self.columns <= set(model.__table__.columns.keys()))
+
+    def __call__(self, obj):
+        return OrderedDict([(key, getter(obj))
+                            for key, getter in self.getters])
+
+    def select(self, query, *columns):
+        """Returns a query of the rows the serializer needs, plus the given
+        columns, if it can work on rows.
+        """
+
+        if not self.from_rows:
+            return query
+
+        columns = set(column.key for column in columns) | self.columns
+
+        return query.with_entities(*[getattr(self.model, column)
+                                     for column in sorted(columns)])
+
+
+def compile_field(key, field):
+    """Returns a (getter, columns) tuple for a field of a resource_fields
+    dictionary. Fields that can't be compiled fall back to their output()
+    method.
+    """
+
+    if isinstance(field, dict):
+        nested = Serializer(field)
+
+        return (nested, nested.columns)
+
+    if isinstance(field, type):
+        field = field()
+
+    if hasattr(field, 'compile'):
+        return field.compile(key)
+
+    attribute = key if field.attribute is None else field.attribute
+    formats = {fields.Raw: None, fields.String: unicode, fields.Integer: int}
+    if type(field) not in formats:
+        return (lambda obj: field.output(key, obj), None)
+
+    default, cast = field.default, formats[type(field)]
+
+    def _get(obj):
+        value = getattr(obj, attribute, None)
+        if value is None:
+            return default
+
+        return cast(value) if cast else value
+
+    return (_get, set([attribute]))
 
 
 class InstanceURI(fields.String):
@@ -10,18 +126,25 @@ class InstanceURI(fields.String):
     def output(self, key, obj):
         return '/%s/%i' % (self.base_uri, obj.pk)
 
+    def compile(self, key):
+        uri = '/%s/%%i' % self.base_uri
+
+        return (lambda obj: uri % obj.pk, set(['pk']))
+
 
 class StreamURI(fields.Raw):
     """ Only tracks can be streamed """
 
     def output(self, key, obj):
-        for mdir in app.config['MEDIA_DIRS']:
-            stream_uri = mdir.urlize(getattr(obj, 'path', ''))
-            if stream_uri:
-                return stream_uri
+        mdir, stream_uri = get_router().resolve(getattr(obj, 'path', ''))
+        if stream_uri:
+            return stream_uri
 
         return '%strack/%s/download.mp3' % (request.url_root, obj.pk)
 
+    def compile(self, key):
+        return (lambda obj: self.output(key, obj), set(['path', 'pk']))
+
 
 class DownloadURI(InstanceURI):
     def output(self, key, obj):
@@ -29,11 +152,17 @@ class DownloadURI(InstanceURI):
 
         return '%s/download.mp3' % uri
 
+    def compile(self, key):
+        uri = '/%s/%%i/download.mp3' % self.base_uri
+
+        return (lambda obj: uri % obj.pk, set(['pk']))
+
 
 class ManyToManyField(fields.Raw):
     def __init__(self, foreign_obj, nested):
         self.foreign_obj = foreign_obj
         self.nested = nested
+        self.serializer = Serializer(nested)
 
         super(ManyToManyField, self).__init__()
 
@@ -44,11 +173,42 @@ class ManyToManyField(fields.Raw):
 
         return items
 
+    def compile(self, key):
+        nested = self.serializer
+
+        return (lambda obj: [nested(item) for item in getattr(obj, key)],
+                None)
+
+    def prefetch(self, key, objects):
+        """Loads the relation of every object through the association table,
+        and sets it as if it was lazy loaded.
+        """
+
+        prop = class_mapper(type(objects[0])).get_property(key)
+        local = prop.synchronize_pairs[0][1]
+        remote = prop.secondary_synchronize_pairs[0][1]
+
+        related = dict((obj.pk, []) for obj in objects)
+        session = self.foreign_obj.query.session
+        for pks in chunks(related):
+            query = session.query(local, self.foreign_obj).select_from(
+                prop.secondary).join(
+                self.foreign_obj, remote == self.foreign_obj.pk).filter(
+                local.in_(pks))
+            for pk, item in query:
+                related[pk].append(item)
+
+        for obj in objects:
+            set_committed_value(obj, key, related[obj.pk])
+
 
 class ForeignKeyField(fields.Raw):
     def __init__(self, foreign_obj, nested):
         self.foreign_obj = foreign_obj
         self.nested = nested
+        self.serializer = Serializer(nested)
+        # Only the primary key of the related object is serialized.
+        self.by_key = self.serializer.columns == set(['pk'])
 
         super(ForeignKeyField, self).__init__()
 
@@ -57,11 +217,78 @@ class ForeignKeyField(fields.Raw):
         if not _id:
             return None
 
+        # Prefetched objects are taken from the session's identity map.
         obj = self.foreign_obj.query.get(_id)
 
         return marshal(obj, self.nested)
 
+    def compile(self, key):
+        """When only the primary key of the related object is serialized,
+        it's taken from the foreign key, without loading the object.
+        """
+
+        attribute = '%s_pk' % key
+        nested = self.serializer
+        if not self.by_key:
+            def _get(obj):
+                _id = getattr(obj, attribute)
+
+                return nested(self.foreign_obj.query.get(_id)) if _id else None
+
+            return (_get, None)
+
+        def _get_by_key(obj):
+            _id = getattr(obj, attribute)
+
+            return nested(Key(_id)) if _id else None
+
+        return (_get_by_key, set([attribute]))
+
+    def prefetch(self, key, objects):
+        """Loads the related object of every object with a single IN query
+        and sets it as if it was lazy loaded. Objects already in the session
+        are not loaded again, and nothing is when only their primary key is
+        serialized.
+        """
+
+        if self.by_key:
+            return
+
+        pks = set(getattr(obj, '%s_pk' % key) for obj in objects)
+        pks.discard(None)
+
+        related = {}
+        mapper = class_mapper(self.foreign_obj)
+        identity_map = self.foreign_obj.query.session.identity_map
+        for pk in list(pks):
+            item = identity_map.get(mapper.identity_key_from_primary_key(
+                (pk,)))
+            if item is not None:
+                related[pk] = item
+                pks.discard(pk)
+
+        for _pks in chunks(pks):
+            query = self.foreign_obj.query.filter(
+                self.foreign_obj.pk.in_(_pks))
+            for item in query:
+                related[item.pk] = item
+
+        for obj in objects:
+            set_committed_value(obj, key,
+                                related.get(getattr(obj, '%s_pk' % key)))
+
 
 class Boolean(fields.Raw):
     def output(self, key, obj):
         return bool(super(Boolean, self).output(key, obj))
+
+    def compile(self, key):
+        attribute = key if self.attribute is None else self.attribute
+        default = self.default
+
+        def _get(obj):
+            value = getattr(obj, attribute, None)
+
+            return bool(default if value is None else value)
+
+        return (_get, set([attribute]))
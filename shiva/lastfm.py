@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+import urllib
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+API_URL = 'http://ws.audioscrobbler.com/2.0/'
+COVER_EXTRA_LARGE = 'extralarge'
+COVER_MEGA = 'mega'
+# The only error cached, as a miss. Others (rate limits, temporary failures)
+# are treated like network errors.
+ERROR_NOT_FOUND = 6
+
+
+class ResponseCache(object):
+    """
+    Persistent cache of Last.fm responses, stored in a SQLite file. Entries
+    expire after `ttl` seconds, or after `miss_ttl` seconds when Last.fm
+    didn't know the artist or album.
+
+    It's safe to share an instance between threads.
+
+    """
+
+    def __init__(self, path, ttl, miss_ttl):
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                          'key TEXT PRIMARY KEY, body TEXT, fetched REAL)')
+        self.conn.commit()
+
+    def get(self, key):
+        """Returns the cached response for the given key. Raises KeyError if
+        there is none or it expired.
+        """
+
+        with self.lock:
+            row = self.conn.execute('SELECT body, fetched FROM responses '
+                                    'WHERE key = ?', (key,)).fetchone()
+        if not row:
+            raise KeyError(key)
+
+        body, fetched = row
+        data = json.loads(body)
+        ttl = self.ttl if data else self.miss_ttl
+        if time.time() - fetched > ttl:
+            raise KeyError(key)
+
+        return data
+
+    def set(self, key, data):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO responses '
+                              '(key, body, fetched) VALUES (?, ?, ?)',
+                              (key, json.dumps(data), time.time()))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class LastFM(object):
+    """
+    Minimal client for the Last.fm web service. Only fetches what Shiva
+    stores: artist images, album covers and release dates.
+
+    Every response, including "not found" ones, goes through the cache when
+    one is given. Network errors and any other Last.fm error are not cached.
+
+    """
+
+    def __init__(self, api_key, url=API_URL, cache=None, timeout=10):
+        self.api_key = api_key
+        self.url = url
+        self.cache = cache
+        self.timeout = timeout
+
+    def call(self, method, **params):
+        params = dict((k, v.encode('utf-8') if isinstance(v, unicode) else v)
+                      for k, v in params.iteritems())
+        key = '%s?%s' % (method, urllib.urlencode(sorted(params.items())))
+
+        if self.cache:
+            try:
+                return self.cache.get(key)
+            except KeyError:
+                pass
+
+        params.update({
+            'method': method,
+            'api_key': self.api_key,
+            'format': 'json',
+        })
+
+        try:
+            response = requests.get(self.url, params=params,
+                                    timeout=self.timeout)
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError), e:
+            logger.warning('Last.fm request %s failed: %s' % (key, e))
+
+            return None
+
+        if not isinstance(data, dict):
+            data = None
+        elif 'error' in data:
+            if data['error'] != ERROR_NOT_FOUND:
+                logger.warning('Last.fm request %s failed: error %s, %s' % (
+                    key, data['error'], data.get('message')))
+
+                return None
+
+            data = None
+
+        if self.cache:
+            self.cache.set(key, data)
+
+        return data
+
+    def get_image(self, data, size):
+        for image in (data or {}).get('image', []):
+            if image.get('size') == size and image.get('#text'):
+                return image['#text']
+
+        return None
+
+    def get_artist_image(self, artist, size=COVER_MEGA):
+        data = self.call('artist.getinfo', artist=artist)
+
+        return self.get_image((data or {}).get('artist'), size)
+
+    def get_album_info(self, artist, album, size=COVER_EXTRA_LARGE):
+        """Returns a (cover, release_year) tuple. Any of them may be None.
+        """
+
+        data = self.call('album.getinfo', artist=artist, album=album)
+        data = (data or {}).get('album') or {}
+
+        year = None
+        _date = (data.get('releasedate') or '').strip()
+        if _date:
+            try:
+                year = datetime.strptime(_date, '%d %b %Y, %H:%M').year
+            except ValueError:
+                pass
+
+        return (self.get_image(data, size), year)
@@ -1,6 +1,6 @@
 from flask import g, current_app as app
 
-from shiva.models import Lyrics
+from shiva.models import Lyrics, bump_revision
 from shiva.utils import _import
 
 
@@ -32,6 +32,7 @@ def get_lyrics(track):
                 lyrics = Lyrics(text=scraper.lyrics, source=scraper.source,
                                 track=track)
                 g.db.session.add(lyrics)
+                bump_revision()
                 g.db.session.commit()
 
                 return lyrics
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import urllib2
 
+from flask import current_app as app
+
 
 class MediaDir(object):
     """This object allows for media configuration. By instantiating a MediaDir
@@ -80,6 +82,7 @@ class MediaDir(object):
         self.root = root
         self.dirs = dirs
         self.url = url
+        self._router = None
 
     def root_slashes(self, path):
         """Removes the trailing slash, and makes sure the path begins with a
@@ -123,30 +126,107 @@ class MediaDir(object):
 
         return dirs
 
-    # TODO: Simplify this method and document it better.
     def urlize(self, path):
+        """Returns the URL of a file, or None if it isn't in any of the dirs
+        or they aren't served through a URL.
         """
+
+        if not self.allowed_to_stream(path):
+            return None
+
+        return self.get_url(path)
+
+    def get_url(self, path):
+        """Returns the URL of a file known to be in one of the dirs, or None
+        if they aren't served through a URL.
         """
 
-        url = None
-        for mdir in self.get_dirs():
-            if path.startswith(mdir):
-                if self.url:
-                    # Remove trailing slash to avoid double-slashed URL.
-                    url = path[len(self.root):]
-                    url = str(url.encode('utf-8'))
+        if not self.url:
+            return None
 
-        if self.url:
-            url = ''.join((self.url.rstrip('/'), urllib2.quote(url)))
+        if self.root != '/':
+            path = path[len(self.root):]
 
-        return url
+        return ''.join((self.url.rstrip('/'),
+                        urllib2.quote(path.encode('utf-8'))))
 
     def allowed_to_stream(self, path):
+        """Tells whether a file is in one of the dirs. Paths are compared by
+        whole components, as MediaRouter does.
         """
+
+        if self._router is None:
+            self._router = MediaRouter([self])
+
+        return self._router.find(path) is self
+
+
+def split_path(path):
+    if isinstance(path, str):
+        path = path.decode('utf-8')
+
+    return [part for part in path.split(u'/') if part]
+
+
+class MediaRouter(object):
+    """
+    The dirs of a list of MediaDirs compiled into a tree of path components,
+    that finds the MediaDir serving a file, and its URL, walking down the path
+    once instead of trying every dir of every MediaDir.
+
+    As when asking each of them in turn, the first MediaDir with a URL wins,
+    then the first one without.
+
+    """
+
+    def __init__(self, media_dirs):
+        # {component: node}, plus the (rank, MediaDir) of the dir ending there
+        # under the None key.
+        self.tree = {}
+        for index, mdir in enumerate(media_dirs):
+            rank = (not mdir.url, index)
+            for path in mdir.get_dirs():
+                node = self.tree
+                for part in split_path(path):
+                    node = node.setdefault(part, {})
+                if None not in node or rank < node[None][0]:
+                    node[None] = (rank, mdir)
+
+    def find(self, path):
+        """Returns the MediaDir serving a file, or None."""
+
+        node = self.tree
+        match = node.get(None)
+        for part in split_path(path):
+            node = node.get(part)
+            if node is None:
+                break
+
+            if None in node and (not match or node[None][0] < match[0]):
+                match = node[None]
+
+        return match[1] if match else None
+
+    def resolve(self, path):
+        """Returns a (MediaDir, URL) tuple for the path of a file. Both are
+        None when no MediaDir has it, and the URL when its MediaDir has none.
         """
 
-        for mdir in self.get_dirs():
-            if path.startswith(mdir):
-                return True
+        mdir = self.find(path)
+        if not mdir:
+            return (None, None)
+
+        return (mdir, mdir.get_url(path))
+
+_router = None
+
+
+def get_router():
+    """Returns the router of the MEDIA_DIRS, compiled on the first call."""
+
+    global _router
+
+    if _router is None:
+        _router = MediaRouter(app.config.get('MEDIA_DIRS', ()))
 
-        return False
+    return _router
@@ -1,42 +1,119 @@
 # -*- coding: utf-8 -*-
+import logging
 import os
+import time
 
 from flask.ext.sqlalchemy import SQLAlchemy
 
+from shiva.mpeg import MPEGError, read_seek_table
 from shiva.utils import slugify as do_slug, randstr, ID3Manager
 
+logger = logging.getLogger(__name__)
+
 db = SQLAlchemy()
 
 __all__ = ('db', 'Artist', 'Album', 'Track')
 
 
-def slugify(model, field_name):
+# Maximum number of bound parameters in a single IN clause.
+IN_CLAUSE_SIZE = 500
+
+
+class SlugIndex(object):
     """
-    Given the instance of a model and a field to slugify, generates a unique
-    slug. If a standard one exists in the DB, or the generated slug is
-    numeric-only, a hyphen and the object's ID is appended to it to generate a
-    unique and alphanumeric one.
+    Keeps the slugs in use for each model in memory, so generating a unique
+    one doesn't take a query. The slugs of a table are loaded the first time
+    they are needed.
+
+    Other processes may be writing to the same tables, reserve() checks a
+    batch of new slugs against the DB before inserting them.
 
     """
 
-    slug = do_slug(getattr(model, field_name, ''))
-    if not slug:
-        slug = randstr(6)
-    try:
-        is_int = isinstance(int(slug), int)
-    except ValueError:
-        is_int = False
+    def __init__(self):
+        self.slugs = {}
+
+    def get_slugs(self, model):
+        if model not in self.slugs:
+            self.slugs[model] = set(slug for slug,
+                                    in db.session.query(model.slug) if slug)
+
+        return self.slugs[model]
+
+    def allocate(self, model, text, extra=None):
+        """
+        Generates a unique slug for the given text. If the standard one is
+        taken, or it's numeric-only, a hyphen and the extra value (or a random
+        string) is appended to it to generate a unique and alphanumeric one.
+
+        """
+
+        slug = do_slug(text)
+        if not slug:
+            slug = randstr(6)
+        try:
+            is_int = isinstance(int(slug), int)
+        except ValueError:
+            is_int = False
 
-    exists = bool(model.__class__.query.filter_by(slug=slug).count())
+        used = self.get_slugs(model)
+        if is_int or slug in used:
+            base = slug
+            slug = u'%s-%s' % (base, extra or randstr(6))
+            while slug in used:
+                slug = u'%s-%s' % (base, randstr(6))
 
-    if is_int or exists:
-        extra = model.pk
-        if not extra:
-            extra = randstr(6)
+        used.add(slug)
 
-        slug += u'-%s' % extra
+        return slug
 
-    return slug
+    def reserve(self, model, rows, field_name):
+        """
+        Makes sure none of the slugs of the given rows, dictionaries or
+        unsaved instances of the model, was stored by another writer since the
+        index was loaded. Those that were get a new slug, generated from
+        field_name. Takes one query per IN_CLAUSE_SIZE rows.
+
+        """
+
+        def _get(row, key):
+            return row[key] if isinstance(row, dict) else getattr(row, key)
+
+        slugs = [_get(row, 'slug') for row in rows]
+        taken = set()
+        for i in xrange(0, len(slugs), IN_CLAUSE_SIZE):
+            query = db.session.query(model.slug).filter(
+                model.slug.in_(slugs[i:i + IN_CLAUSE_SIZE]))
+            taken.update(slug for slug, in query)
+
+        if not taken:
+            return 0
+
+        self.get_slugs(model).update(taken)
+        for row in rows:
+            if _get(row, 'slug') in taken:
+                slug = self.allocate(model, _get(row, field_name))
+                if isinstance(row, dict):
+                    row['slug'] = slug
+                else:
+                    row.slug = slug
+
+        return len(taken)
+
+    def clear(self):
+        self.slugs = {}
+
+slugs = SlugIndex()
+
+
+def slugify(model, text):
+    """
+    Given the instance of a model and the text to slugify, generates a unique
+    slug. See SlugIndex.allocate().
+
+    """
+
+    return slugs.allocate(model.__class__, text, model.pk)
 
 
 class Artist(db.Model):
@@ -44,6 +121,8 @@ class Artist(db.Model):
     """
 
     __tablename__ = 'artists'
+    # The order of the listings, see resources.paginate().
+    __table_args__ = (db.Index('ix_artists_sort', 'name', 'pk'),)
 
     pk = db.Column(db.Integer, primary_key=True)
     # TODO: Update the files' ID3 tags when changing this info.
@@ -55,8 +134,8 @@ class Artist(db.Model):
     tracks = db.relationship('Track', backref='artist', lazy='dynamic')
 
     def __setattr__(self, attr, value):
-        if attr == 'name':
-            super(Artist, self).__setattr__('slug', slugify(self, 'name'))
+        if attr == 'name' and value != getattr(self, 'name', None):
+            super(Artist, self).__setattr__('slug', slugify(self, value))
 
         super(Artist, self).__setattr__(attr, value)
 
@@ -75,6 +154,7 @@ class Album(db.Model):
     """
 
     __tablename__ = 'albums'
+    __table_args__ = (db.Index('ix_albums_sort', 'year', 'name', 'pk'),)
 
     pk = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), nullable=False)
@@ -88,8 +168,8 @@ class Album(db.Model):
                               backref=db.backref('albums', lazy='dynamic'))
 
     def __setattr__(self, attr, value):
-        if attr == 'name':
-            super(Album, self).__setattr__('slug', slugify(self, 'name'))
+        if attr == 'name' and value != getattr(self, 'name', None):
+            super(Album, self).__setattr__('slug', slugify(self, value))
 
         super(Album, self).__setattr__(attr, value)
 
@@ -102,6 +182,7 @@ class Track(db.Model):
     """
 
     __tablename__ = 'tracks'
+    __table_args__ = (db.Index('ix_tracks_sort', 'album_pk', 'number', 'pk'),)
 
     pk = db.Column(db.Integer, primary_key=True)
     path = db.Column(db.Unicode(256), unique=True, nullable=False)
@@ -111,13 +192,22 @@ class Track(db.Model):
     file_size = db.Column(db.Integer)
     length = db.Column(db.Integer)
     number = db.Column(db.Integer)
+    # Size and hash of the audio frames, see shiva.mpeg.fingerprint().
+    fingerprint = db.Column(db.String(64), index=True)
+    # Offsets of the MPEG frames, see shiva.mpeg.build_seek_table(). Only
+    # loaded when accessed. Taken from the file's Xing header when it has
+    # one, otherwise built by the indexer once the track is stored.
+    seek_table = db.deferred(db.Column(db.LargeBinary))
 
     lyrics = db.relationship('Lyrics', backref='track', uselist=False)
 
     album_pk = db.Column(db.Integer, db.ForeignKey('albums.pk'))
     artist_pk = db.Column(db.Integer, db.ForeignKey('artists.pk'))
 
-    def __init__(self, path):
+    def __init__(self, path, id3r=None):
+        """The optional id3r lets the caller provide an already loaded reader
+        (an ID3Manager or a TrackInfo) so the file isn't parsed twice.
+        """
         if type(path) not in (unicode, str, file):
             raise ValueError('Invalid parameter for Track. Path or File '
                              'expected, got %s' % type(path))
@@ -126,12 +216,13 @@ class Track(db.Model):
         if isinstance(path, file):
             _path = path.name
 
+        self._id3r = id3r
         self.set_path(_path)
         self._id3r = None
 
     def __setattr__(self, attr, value):
-        if attr == 'title':
-            super(Track, self).__setattr__('slug', slugify(self, 'title'))
+        if attr == 'title' and value != getattr(self, 'title', None):
+            super(Track, self).__setattr__('slug', slugify(self, value))
 
         super(Track, self).__setattr__(attr, value)
 
@@ -145,11 +236,37 @@ class Track(db.Model):
         if path != self.get_path():
             self.path = path
             if os.path.exists(self.get_path()):
-                self.file_size = self.get_id3_reader().size
-                self.bitrate = self.get_id3_reader().bitrate
-                self.length = self.get_id3_reader().length
-                self.number = self.get_id3_reader().track_number
-                self.title = self.get_id3_reader().title
+                self.read_metadata()
+
+    def read_metadata(self, id3r=None):
+        """Copies the file's metadata into the track. Useful to refresh a
+        track whose file was modified.
+        """
+        id3r = id3r or self.get_id3_reader()
+
+        self.file_size = id3r.size
+        self.bitrate = id3r.bitrate
+        self.length = id3r.length
+        self.number = id3r.track_number
+        self.fingerprint = getattr(id3r, 'fingerprint', None)
+        self.seek_table = getattr(id3r, 'seek_table', None)
+        self.title = id3r.title
+
+    def get_seek_table(self):
+        """Returns the seek table of the track. An empty string means the
+        file has none. Tracks the indexer hasn't got to yet have theirs built
+        from the file, which is read whole, but not stored: requests never
+        write to the database. Raises IOError if the file can't be read.
+        """
+
+        if self.seek_table is not None:
+            return self.seek_table
+
+        logger.warning('%s has no seek table yet, reading it.' % self.path)
+        try:
+            return read_seek_table(self.get_path())
+        except MPEGError:
+            return ''
 
     def get_id3_reader(self):
         """Returns an object with the ID3 info reader.
@@ -163,6 +280,85 @@ class Track(db.Model):
         return "<Track ('%s')>" % self.title
 
 
+class IndexedFile(db.Model):
+    """
+    Keeps the stat information of every indexed file, so the indexer can tell
+    which files changed since the last run without opening them.
+    """
+
+    __tablename__ = 'indexed_files'
+
+    pk = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.Unicode(256), unique=True, nullable=False)
+    size = db.Column(db.Integer)
+    # In microseconds.
+    mtime = db.Column(db.BigInteger)
+    inode = db.Column(db.BigInteger)
+
+    def __repr__(self):
+        return "<IndexedFile ('%s')>" % self.path
+
+
+class PendingFile(db.Model):
+    """
+    A file the indexer couldn't store when running non-interactively, because
+    its tags lack the artist, album or title. The known values are kept so
+    they can be completed later.
+    """
+
+    __tablename__ = 'pending_files'
+
+    pk = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.Unicode(256), unique=True, nullable=False)
+    artist = db.Column(db.String(128))
+    album = db.Column(db.String(128))
+    title = db.Column(db.String(128))
+
+    def get_path(self):
+        return self.path.encode('utf-8')
+
+    @classmethod
+    def under(cls, path):
+        """Returns a query for the pending files at the given path or inside
+        it, leaving out siblings that merely share its name as a prefix. An
+        empty path matches every file.
+        """
+
+        query = cls.query
+        if path:
+            path = path.decode('utf-8') if isinstance(path, str) else path
+            path = os.path.normpath(path)
+            prefix = os.path.join(path, '')
+            for char in '\\%_':
+                prefix = prefix.replace(char, '\\' + char)
+
+            query = query.filter(db.or_(
+                cls.path == path, cls.path.like(prefix + '%', escape='\\')))
+
+        return query
+
+    def __repr__(self):
+        return "<PendingFile ('%s')>" % self.path
+
+
+class TagEdit(db.Model):
+    """
+    A change to the tags of a file, waiting to be written. The indexer never
+    writes to the media files, tagger.py applies the edits in bulk.
+    """
+
+    __tablename__ = 'tag_edits'
+    __table_args__ = (db.UniqueConstraint('path', 'field'),)
+
+    pk = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.Unicode(256), nullable=False)
+    field = db.Column(db.String(32), nullable=False)
+    value = db.Column(db.Unicode(256))
+
+    def __repr__(self):
+        return "<TagEdit ('%s', %s)>" % (self.path, self.field)
+
+
 class Lyrics(db.Model):
     """
     """
@@ -178,3 +374,40 @@ class Lyrics(db.Model):
 
     def __repr__(self):
         return "<Lyrics ('%s')>" % self.track.title
+
+
+class Revision(db.Model):
+    """
+    A single row counting the changes to the library, so the API knows when
+    the responses it cached are stale. Whatever changes the library calls
+    bump_revision() before committing.
+    """
+
+    __tablename__ = 'revisions'
+
+    pk = db.Column(db.Integer, primary_key=True)
+    number = db.Column(db.Integer, nullable=False)
+    # Unix time of the last change. Always moves forward by at least one
+    # second, so it can be used for Last-Modified.
+    modified = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return "<Revision (%i)>" % self.number
+
+
+def get_revision():
+    """Returns the library's revision as a (number, modified) tuple."""
+
+    row = db.session.query(Revision.number, Revision.modified).first()
+
+    return tuple(row) if row else (0, 0)
+
+
+def bump_revision():
+    revision = Revision.query.first()
+    if not revision:
+        revision = Revision(number=0, modified=0)
+        db.session.add(revision)
+
+    revision.number += 1
+    revision.modified = max(int(time.time()), revision.modified + 1)
@@ -0,0 +1,522 @@
+# -*- coding: utf-8 -*-
+"""
+A minimal MP3 reader. It only reads what Shiva stores: a few ID3 frames and
+the information needed to compute the bitrate and length of the file, skipping
+the audio data.
+
+Seek tables are made from the TOC of the Xing header when there is one.
+Otherwise read_seek_table() builds one from the MPEG frame headers, which
+means reading the whole file, so it's only done when a client seeks.
+
+Whatever it can't handle (unsynchronised or compressed tags, files without a
+recognisable MPEG frame near the beginning) raises MPEGError, so the caller
+can fall back to a complete reader like eyed3.
+"""
+import hashlib
+import os
+import struct
+
+# Bytes read after the ID3v2 tag looking for the first MPEG frame.
+SYNC_SEARCH = 16384
+# Bytes of audio hashed at the beginning, middle and end of a file to
+# fingerprint it.
+FINGERPRINT_SAMPLE = 16384
+# Frames between two entries of a seek table, and bytes read at a time while
+# building it.
+SEEK_TABLE_FRAMES = 32
+SEEK_TABLE_READ = 65536
+# Seek table header: samples per frame, sample rate and frames per entry.
+# Followed by the offset of every entry, as 32 bits integers. Tables made from
+# a Xing TOC have no frames per entry, and are followed by XING_TOC instead:
+# offset of the Xing frame, frames and bytes of the stream, and the TOC.
+SEEK_TABLE_HEADER = struct.Struct('<HHH')
+SEEK_TABLE_ENTRY = struct.Struct('<I')
+XING_TOC = struct.Struct('<3I100s')
+
+# Frames wanted for each field, by order of preference. The release year
+# follows eyed3's choice first, then falls back to the recording date.
+FRAMES = {
+    'artist': ('TPE1', 'TP1'),
+    'album': ('TALB', 'TAL'),
+    'title': ('TIT2', 'TT2'),
+    'track_number': ('TRCK', 'TRK'),
+    'release_year': ('TDRL', 'TORY', 'TOR', 'TDRC', 'TYER', 'TYE'),
+}
+WANTED = set(frame for frames in FRAMES.values() for frame in frames)
+
+# Kbps, indexed by [MPEG version is 1][layer - 1][bitrate index].
+BITRATES = {
+    True: (
+        (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416,
+         448),
+        (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    ),
+    False: (
+        (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    ),
+}
+SAMPLE_RATES = (44100, 48000, 32000)
+# Version bits to (version, sample rate divisor).
+VERSIONS = {3: (1, 1), 2: (2, 2), 0: (2.5, 4)}
+
+
+class MPEGError(Exception):
+    pass
+
+
+def syncsafe(data):
+    """Decodes a 28 bits integer stored in 4 bytes of 7 bits each."""
+    b = struct.unpack('>4B', data)
+
+    return (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+
+
+def unpack(fmt, data, offset=0):
+    """Like struct.unpack_from(), but raises MPEGError when the data is too
+    short, as in damaged or truncated files.
+    """
+
+    try:
+        return struct.unpack_from(fmt, data, offset)
+    except struct.error:
+        raise MPEGError('Truncated header.')
+
+
+def decode_text(data):
+    """Decodes the content of an ID3v2 text frame, returning only its first
+    string.
+    """
+
+    if not data:
+        return u''
+
+    encoding, data = ord(data[0]), data[1:]
+    if encoding in (1, 2):
+        codec = 'utf-16' if encoding == 1 else 'utf-16-be'
+        if len(data) % 2:
+            data = data[:-1]
+        text = data.decode(codec, 'replace')
+    elif encoding == 3:
+        text = data.decode('utf-8', 'replace')
+    else:
+        text = data.decode('latin-1')
+
+    return text.split(u'\x00')[0].strip()
+
+
+def fingerprint(f, start, end):
+    """Returns a cheap fingerprint of the bytes of a file between start and
+    end: their size plus a hash of three samples taken at the beginning, the
+    middle and the end. Given the offsets of the audio frames, it survives
+    renames, moves and tag edits.
+    """
+
+    size = max(end - start, 0)
+    digest = hashlib.sha1()
+    if size <= FINGERPRINT_SAMPLE * 3:
+        offsets = (start,)
+        length = size
+    else:
+        offsets = (start, start + (size - FINGERPRINT_SAMPLE) / 2,
+                   end - FINGERPRINT_SAMPLE)
+        length = FINGERPRINT_SAMPLE
+
+    for offset in offsets:
+        f.seek(offset)
+        digest.update(f.read(length))
+
+    return '%i-%s' % (size, digest.hexdigest())
+
+
+def find_frame(data):
+    """Returns the (offset, FrameHeader) of the first MPEG frame in data,
+    checking the next one to tell it from a false sync. Raises MPEGError if
+    there is none.
+    """
+
+    offset = data.find('\xff')
+    while offset != -1:
+        try:
+            frame = FrameHeader(data[offset:offset + 4])
+            following = data[offset + frame.length:
+                             offset + frame.length + 4]
+            if len(following) == 4:
+                FrameHeader(following)
+
+            return (offset, frame)
+        except MPEGError:
+            offset = data.find('\xff', offset + 1)
+
+    raise MPEGError('No MPEG frame found.')
+
+
+def build_seek_table(f, start, end, first_frame):
+    """
+    Walks the MPEG frame headers between start and end, and returns a seek
+    table with the offset of every SEEK_TABLE_FRAMES frames. It's a string,
+    packed as SEEK_TABLE_HEADER and SEEK_TABLE_ENTRY say, to be stored as is.
+    The walk stops at the first thing that isn't a frame.
+
+    """
+
+    # Frame lengths only depend on the first 3 bytes of the header.
+    lengths = {}
+    offsets = []
+    count = 0
+    position = data_start = start
+    data = ''
+    while position + 4 <= end:
+        index = position - data_start
+        if index + 4 > len(data):
+            f.seek(position)
+            data = f.read(SEEK_TABLE_READ)
+            data_start = position
+            index = 0
+            if len(data) < 4:
+                break
+
+        key = data[index:index + 3]
+        length = lengths.get(key)
+        if length is None:
+            try:
+                length = FrameHeader(data[index:index + 4]).length
+            except MPEGError:
+                break
+
+            lengths[key] = length
+
+        if not count % SEEK_TABLE_FRAMES:
+            offsets.append(position)
+        count += 1
+        position += length
+
+    return SEEK_TABLE_HEADER.pack(first_frame.samples,
+                                  first_frame.sample_rate,
+                                  SEEK_TABLE_FRAMES) + \
+        struct.pack('<%iI' % len(offsets), *offsets)
+
+
+def toc_seek_table(first_frame, start, frames, audio_bytes, toc):
+    """
+    Returns a seek table made from the TOC of a Xing header, which gives the
+    position in the stream at every percent of its duration, in 256ths of
+    audio_bytes from start.
+
+    """
+
+    return SEEK_TABLE_HEADER.pack(first_frame.samples,
+                                  first_frame.sample_rate, 0) + \
+        XING_TOC.pack(start, frames, audio_bytes, toc)
+
+
+def read_seek_table(path):
+    """Builds the seek table of a file walking all its frame headers, see
+    build_seek_table(). Raises MPEGError if the file can't be read by MP3Info.
+    """
+
+    info = MP3Info(path)
+    with open(path, 'rb') as f:
+        return build_seek_table(f, info.frames_start, info.audio_end,
+                                info.first_frame)
+
+
+def seek(table, seconds, f=None):
+    """
+    Returns the offset of the frame playing at the given second, out of a
+    seek table. The table points to a frame at most SEEK_TABLE_FRAMES before
+    it. Given the open file, the frames in between are skipped reading their
+    headers.
+
+    Tables made from a Xing TOC only point near the frame. Given the open
+    file, the offset is moved to the next frame.
+
+    """
+
+    samples, sample_rate, every = SEEK_TABLE_HEADER.unpack_from(table)
+    if not every:
+        return seek_toc(table, seconds * sample_rate / samples, f)
+
+    entries = (len(table) - SEEK_TABLE_HEADER.size) / SEEK_TABLE_ENTRY.size
+    if not entries:
+        return None
+
+    frame = int(seconds * sample_rate / samples)
+    entry = min(frame / every, entries - 1)
+    (offset,) = SEEK_TABLE_ENTRY.unpack_from(
+        table, SEEK_TABLE_HEADER.size + entry * SEEK_TABLE_ENTRY.size)
+
+    if f is not None:
+        for i in xrange(min(frame - entry * every, every - 1)):
+            f.seek(offset)
+            try:
+                offset += FrameHeader(f.read(4)).length
+            except MPEGError:
+                break
+
+    return offset
+
+
+def seek_toc(table, frame, f=None):
+    start, frames, audio_bytes, toc = XING_TOC.unpack_from(
+        table, SEEK_TABLE_HEADER.size)
+    if not frames:
+        return None
+
+    percent = min(frame * 100.0 / frames, 99.99)
+    i = int(percent)
+    low = ord(toc[i])
+    high = ord(toc[i + 1]) if i < 99 else 256
+    offset = start + int((low + (high - low) * (percent - i)) *
+                         audio_bytes / 256)
+
+    if f is not None:
+        f.seek(offset)
+        try:
+            offset += find_frame(f.read(SYNC_SEARCH))[0]
+        except MPEGError:
+            pass
+
+    return offset
+
+
+class FrameHeader(object):
+    """The 4 bytes header of an MPEG audio frame."""
+
+    def __init__(self, data):
+        if len(data) < 4:
+            raise MPEGError('Truncated frame header.')
+
+        (header,) = struct.unpack('>I', data[:4])
+        if header >> 21 != 0x7FF:
+            raise MPEGError('No frame sync.')
+
+        version_bits = (header >> 19) & 3
+        layer_bits = (header >> 17) & 3
+        bitrate_index = (header >> 12) & 15
+        sample_rate_index = (header >> 10) & 3
+        if (version_bits not in VERSIONS or not layer_bits or
+                bitrate_index in (0, 15) or sample_rate_index == 3):
+            raise MPEGError('Invalid frame header.')
+
+        self.version, divisor = VERSIONS[version_bits]
+        self.layer = 4 - layer_bits
+        self.bitrate = BITRATES[self.version == 1][self.layer - 1][
+            bitrate_index]
+        self.sample_rate = SAMPLE_RATES[sample_rate_index] / divisor
+        self.padding = (header >> 9) & 1
+        self.mono = ((header >> 6) & 3) == 3
+
+        if self.layer == 1:
+            self.samples = 384
+            self.length = (12000 * self.bitrate / self.sample_rate +
+                           self.padding) * 4
+        else:
+            self.samples = 576 if self.layer == 3 and self.version != 1 \
+                else 1152
+            self.length = (125 * self.samples * self.bitrate /
+                           self.sample_rate + self.padding)
+
+    def get_xing_offset(self):
+        """Offset of the Xing/Info header from the start of the frame, right
+        after the side information.
+        """
+
+        if self.version == 1:
+            return 4 + (17 if self.mono else 32)
+
+        return 4 + (9 if self.mono else 17)
+
+
+class MP3Info(object):
+    """
+    Reads the tags, bitrate and length of an MP3 file. Exposes the same
+    attributes as an ID3Manager, so a TrackInfo can be built out of it.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.artist = self.album = self.title = u''
+        self.track_number = self.release_year = None
+        # Xing/Info or VBRI data, if any.
+        self.frames = self.audio_bytes = self.toc = None
+        self.vbr = False
+        self.seek_table = None
+
+        with open(path, 'rb') as mp3:
+            self.size = os.fstat(mp3.fileno()).st_size
+            tags = self.read_id3v2(mp3)
+            self.audio_end = self.size
+            if self.read_id3v1(mp3, fill=not tags):
+                self.audio_end -= 128
+            self.read_audio(mp3)
+            self.fingerprint = fingerprint(mp3, self.audio_start,
+                                           self.audio_end)
+
+        if self.toc and self.frames and self.audio_bytes:
+            self.seek_table = toc_seek_table(self.first_frame,
+                                             self.audio_start, self.frames,
+                                             self.audio_bytes, self.toc)
+
+    def read_id3v2(self, mp3):
+        """Reads the wanted frames of the ID3v2 tag, skipping the rest.
+        Returns whether there was a tag.
+        """
+
+        self.audio_start = 0
+        header = mp3.read(10)
+        if len(header) < 10 or header[:3] != 'ID3':
+            return False
+
+        major, flags = ord(header[3]), ord(header[5])
+        if major not in (2, 3, 4):
+            raise MPEGError('Unknown ID3v2 version 2.%i.' % major)
+        if flags & 0x80:
+            raise MPEGError('Unsynchronised tag.')
+
+        size = syncsafe(header[6:10])
+        self.audio_start = 10 + size + (10 if flags & 0x10 else 0)
+        end = 10 + size
+
+        if flags & 0x40 and major > 2:
+            # Extended header. In 2.4 its size includes itself.
+            ext_size = mp3.read(4)
+            if len(ext_size) < 4:
+                raise MPEGError('Truncated extended header.')
+            if major == 4:
+                mp3.seek(syncsafe(ext_size) - 4, os.SEEK_CUR)
+            else:
+                mp3.seek(unpack('>I', ext_size)[0], os.SEEK_CUR)
+
+        id_size = 3 if major == 2 else 4
+        header_size = 6 if major == 2 else 10
+        values = {}
+        while mp3.tell() + header_size <= end:
+            frame = mp3.read(header_size)
+            frame_id = frame[:id_size]
+            if not frame_id.strip('\x00') or len(frame) < header_size:
+                break  # Padding.
+
+            if major == 2:
+                frame_size = struct.unpack('>I', '\x00' + frame[3:6])[0]
+                unsupported = 0
+            elif major == 3:
+                frame_size = struct.unpack('>I', frame[4:8])[0]
+                # Compression, encryption.
+                unsupported = ord(frame[9]) & 0xC0
+            else:
+                frame_size = syncsafe(frame[4:8])
+                # Compression, encryption, unsynchronisation, data length.
+                unsupported = ord(frame[9]) & 0x0F
+
+            if frame_id not in WANTED:
+                mp3.seek(frame_size, os.SEEK_CUR)
+                continue
+
+            if unsupported:
+                raise MPEGError('Unsupported flags in frame %s.' % frame_id)
+
+            values[frame_id] = decode_text(mp3.read(frame_size))
+
+        for field, frame_ids in FRAMES.iteritems():
+            for frame_id in frame_ids:
+                if values.get(frame_id):
+                    setattr(self, field, values[frame_id])
+                    break
+
+        self.track_number = self.parse_int(self.track_number, '/')
+        self.release_year = self.parse_int(self.release_year, '-')
+
+        return True
+
+    def read_id3v1(self, mp3, fill=False):
+        """Checks whether there's an ID3v1 tag, using its values if fill is
+        set.
+        """
+
+        if self.size < 128:
+            return False
+
+        mp3.seek(-128, os.SEEK_END)
+        tag = mp3.read(128)
+        if tag[:3] != 'TAG':
+            return False
+
+        if fill:
+            def _text(data):
+                return data.split('\x00')[0].decode('latin-1').strip()
+
+            self.title = _text(tag[3:33])
+            self.artist = _text(tag[33:63])
+            self.album = _text(tag[63:93])
+            self.release_year = self.parse_int(_text(tag[93:97]))
+            if tag[125] == '\x00' and tag[126] != '\x00':
+                self.track_number = ord(tag[126])
+
+        return True
+
+    def read_audio(self, mp3):
+        """Finds the first MPEG frame and computes the bitrate and length of
+        the file from it, its Xing/Info or VBRI header if present.
+        """
+
+        mp3.seek(self.audio_start)
+        data = mp3.read(SYNC_SEARCH)
+        offset, frame = find_frame(data)
+
+        self.audio_start += offset
+        self.first_frame = frame
+        data = data[offset:]
+
+        # The frame holding a Xing/Info or VBRI header has no audio.
+        self.frames_start = self.audio_start + frame.length
+        xing = frame.get_xing_offset()
+        if data[xing:xing + 4] in ('Xing', 'Info'):
+            self.read_xing(data[xing:])
+        elif data[36:40] == 'VBRI':
+            self.read_vbri(data[36:])
+        else:
+            self.frames_start = self.audio_start
+
+        audio_size = self.audio_end - self.audio_start
+        if self.frames:
+            length = float(self.frames * frame.samples) / frame.sample_rate
+            self.length = int(length)
+            audio_size = self.audio_bytes or audio_size
+            self.bitrate = int(audio_size * 8 / length / 1000) \
+                if self.vbr and length else frame.bitrate
+        else:
+            self.bitrate = frame.bitrate
+            self.length = audio_size * 8 / (frame.bitrate * 1000)
+
+    def read_xing(self, data):
+        self.vbr = data[:4] == 'Xing'
+        (flags,) = unpack('>I', data, 4)
+        position = 8
+        if flags & 1:
+            (self.frames,) = unpack('>I', data, position)
+            position += 4
+        if flags & 2:
+            (self.audio_bytes,) = unpack('>I', data, position)
+            position += 4
+        if flags & 4:
+            (self.toc,) = unpack('100s', data, position)
+
+    def read_vbri(self, data):
+        self.vbr = True
+        self.audio_bytes, self.frames = unpack('>II', data, 10)
+
+    def parse_int(self, value, separator=None):
+        if not value:
+            return None
+
+        if separator:
+            value = value.split(separator)[0]
+
+        try:
+            return int(value)
+        except ValueError:
+            return None
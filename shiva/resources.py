@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
+import base64
 from datetime import datetime
+import json
 import logging
+import urllib
 import urllib2
 
-from flask import request, Response, current_app as app, g
+from flask import (request, Response, current_app as app, g,
+                   stream_with_context)
 from flask.ext.restful import abort, fields, marshal, Resource
 from lxml import etree
 import requests
+from sqlalchemy import and_, or_
 
+from shiva.cache import cached
 from shiva.fields import (Boolean, DownloadURI, ForeignKeyField, InstanceURI,
-                          ManyToManyField, StreamURI)
-from shiva.models import Artist, Album, Track, Lyrics
+                          ManyToManyField, Serializer, StreamURI, prefetch)
+from shiva.models import Artist, Album, Track, Lyrics, bump_revision
 from shiva.lyrics import get_lyrics
 
 logger = logging.getLogger(__name__)
@@ -18,6 +24,10 @@ logger = logging.getLogger(__name__)
 DEFAULT_ALBUM_COVER = ('http://wortraub.com/wp-content/uploads/2012/07/'
                        'Vinyl_Close_Up.jpg')
 DEFAULT_ARTIST_IMAGE = 'http://www.super8duncan.com/images/band_silhouette.jpg'
+# Page size used with a cursor when no page_size is given.
+CURSOR_PAGE_SIZE = 100
+# Rows read, prefetched and serialized at a time when streaming a listing.
+STREAM_BATCH_SIZE = 500
 
 
 class JSONResponse(Response):
@@ -47,35 +57,164 @@ def full_tree():
     return (arg and arg not in ('false', '0'))
 
 
-def paginate(queryset):
+def paginate(queryset, sort_keys=None):
     """
     Function that receives a queryset and paginates it based on the GET
-    parameters.
+    parameters. Returns a (rows, headers) tuple. When no page was requested
+    rows is the queryset itself, for list_response() to stream it.
+
+    With a *cursor* parameter (empty for the first page) the page starts right
+    after the row the cursor points to, according to the sort_keys the
+    queryset is ordered by. Unlike *page*, that takes the same time at any
+    depth. The Link header points to the next page, if there is one.
+
+    The total number of rows is only counted when the *count* parameter is
+    given, and sent in the X-Total-Count header.
 
     """
 
+    headers = {}
+    if request.args.get('count') not in (None, 'false', '0'):
+        headers['X-Total-Count'] = str(queryset.count())
+
     try:
         page_size = int(request.args.get('page_size', 0))
     except ValueError:
         page_size = 0
 
+    cursor = request.args.get('cursor')
+    if cursor is not None and sort_keys:
+        page_size = page_size if page_size > 0 else CURSOR_PAGE_SIZE
+        if cursor:
+            queryset = queryset.filter(after(sort_keys,
+                                             decode_cursor(cursor, sort_keys)))
+
+        # One more row tells whether there's a next page.
+        rows = queryset.limit(page_size + 1).all()
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            headers['Link'] = '<%s>; rel="next"' % get_page_uri(
+                encode_cursor(rows[-1], sort_keys))
+
+        return (rows, headers)
+
     try:
         page_number = int(request.args.get('page', 0))
     except ValueError:
         page_number = 0
 
     if not page_size or not page_number:
-        return queryset
-
-    total = queryset.count()
-
-    if total < page_size:
-        return queryset
+        return (queryset, headers)
 
     limit = page_size
     offset = page_size * (page_number - 1)
 
-    return queryset.limit(limit).offset(offset)
+    return (queryset.limit(limit).offset(offset).all(), headers)
+
+
+def list_response(rows, serializer, headers):
+    """
+    Serializes a listing. A page, given as a list, is returned whole. A
+    queryset is streamed as a JSON array, reading and serializing a batch of
+    rows at a time, so neither the rows nor the JSON of a big library are
+    ever held in memory at once.
+
+    The related objects are prefetched unless the rows come from the
+    serializer's select(), which needs none.
+
+    """
+
+    def _prefetch(batch):
+        if not serializer.from_rows:
+            prefetch(batch, serializer.resource_fields)
+
+    if isinstance(rows, list):
+        _prefetch(rows)
+
+        return ([serializer(row) for row in rows], 200, headers)
+
+    def _encode(batch):
+        _prefetch(batch)
+
+        return ', '.join(json.dumps(serializer(row)) for row in batch)
+
+    def _stream():
+        yield '['
+        batch = []
+        separator = ''
+        for row in rows.yield_per(STREAM_BATCH_SIZE):
+            batch.append(row)
+            if len(batch) == STREAM_BATCH_SIZE:
+                yield separator + _encode(batch)
+                batch = []
+                separator = ', '
+
+        if batch:
+            yield separator + _encode(batch)
+        yield ']'
+
+    return JSONResponse(response=stream_with_context(_stream()),
+                        headers=headers.items())
+
+
+def after(sort_keys, values):
+    """
+    Returns the condition matching the rows that come after the given values
+    when sorting by sort_keys, in ascending order. NULLs go first, as SQLite
+    and MySQL sort them.
+
+    """
+
+    key, value = sort_keys[0], values[0]
+    if value is None:
+        greater, equal = (key != None), (key == None)
+    else:
+        greater, equal = (key > value), (key == value)
+
+    if len(sort_keys) == 1:
+        return greater
+
+    condition = or_(greater, and_(equal, after(sort_keys[1:], values[1:])))
+    if value is not None:
+        # Lets the database start from the index instead of filtering.
+        condition = and_(key >= value, condition)
+
+    return condition
+
+
+def encode_cursor(row, sort_keys):
+    values = [getattr(row, key.key) for key in sort_keys]
+
+    return base64.urlsafe_b64encode(json.dumps(values)).rstrip('=')
+
+
+def decode_cursor(cursor, sort_keys):
+    try:
+        cursor = str(cursor)
+        values = json.loads(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        values = None
+
+    if not isinstance(values, list) or len(values) != len(sort_keys):
+        abort(400)
+
+    # Only what encode_cursor() writes: names, pks and years, which can be
+    # null. Anything else would reach the query as a list or a dict.
+    for value in values:
+        if isinstance(value, bool) or not (
+                value is None or isinstance(value, (int, long, unicode))):
+            abort(400)
+
+    return values
+
+
+def get_page_uri(cursor):
+    args = dict((key, value.encode('utf-8'))
+                for key, value in request.args.iteritems())
+    args['cursor'] = cursor
+
+    return '%s?%s' % (request.base_url, urllib.urlencode(sorted(args.items())))
 
 
 class ArtistResource(Resource):
@@ -83,6 +222,8 @@ class ArtistResource(Resource):
     """
 
     route_base = 'artists'
+    method_decorators = [cached]
+    sort_keys = (Artist.name, Artist.pk)
     resource_fields = {
         'id': fields.Integer(attribute='pk'),
         'name': fields.String,
@@ -92,10 +233,11 @@ class ArtistResource(Resource):
         'image': fields.String(default=DEFAULT_ARTIST_IMAGE),
         'events_uri': fields.String(attribute='events'),
     }
+    serializer = Serializer(resource_fields, Artist)
 
     def get(self, artist_id=None, artist_slug=None):
         if not artist_id and not artist_slug:
-            return list(self.get_all())
+            return self.get_all()
 
         if not artist_id and artist_slug:
             artist = self.get_by_slug(artist_slug)
@@ -105,11 +247,14 @@ class ArtistResource(Resource):
         if full_tree():
             return self.get_full_tree(artist)
 
-        return marshal(artist, self.resource_fields)
+        return self.serializer(artist)
 
     def get_all(self):
-        for artist in paginate(Artist.query.order_by(Artist.name)):
-            yield marshal(artist, self.resource_fields)
+        queryset = self.serializer.select(
+            Artist.query, *self.sort_keys).order_by(*self.sort_keys)
+        artists, headers = paginate(queryset, self.sort_keys)
+
+        return list_response(artists, self.serializer, headers)
 
     def get_one(self, artist_id):
         artist = Artist.query.get(artist_id)
@@ -128,13 +273,28 @@ class ArtistResource(Resource):
         return artist
 
     def get_full_tree(self, artist):
-        _artist = marshal(artist, self.resource_fields)
+        """
+        Retrieves the artist with all of its albums and their tracks. The
+        tracks of every album are loaded with a single query and grouped in
+        memory, instead of running a query per album.
+
+        """
+
+        _artist = self.serializer(artist)
         _artist['albums'] = []
 
         albums = AlbumResource()
+        _albums = prefetch(artist.albums.all(), albums.resource_fields)
+
+        query = Track.query.join(Track.album).join(Album.artists).filter(
+            Artist.pk == artist.pk).order_by(Track.number, Track.title)
+        tracks = dict((album.pk, []) for album in _albums)
+        for track in prefetch(query.all(), TracksResource.resource_fields):
+            tracks[track.album_pk].append(track)
 
-        for album in artist.albums:
-            _artist['albums'].append(albums.get_full_tree(album))
+        for album in _albums:
+            _artist['albums'].append(albums.get_full_tree(
+                album, tracks=tracks[album.pk]))
 
         return _artist
 
@@ -147,6 +307,7 @@ class ArtistResource(Resource):
             return JSONResponse(404)
 
         g.db.session.delete(artist)
+        bump_revision()
         g.db.session.commit()
 
         return {}
@@ -157,6 +318,8 @@ class AlbumResource(Resource):
     """
 
     route_base = 'albums'
+    method_decorators = [cached]
+    sort_keys = (Album.year, Album.name, Album.pk)
     resource_fields = {
         'id': fields.Integer(attribute='pk'),
         'name': fields.String,
@@ -170,10 +333,11 @@ class AlbumResource(Resource):
         'download_uri': DownloadURI('album'),
         'cover': fields.String(default=DEFAULT_ALBUM_COVER),
     }
+    serializer = Serializer(resource_fields, Album)
 
     def get(self, album_id=None, album_slug=None):
         if not album_id and not album_slug:
-            return list(self.get_many())
+            return self.get_many()
 
         if not album_id and album_slug:
             album = self.get_by_slug(album_slug)
@@ -183,7 +347,7 @@ class AlbumResource(Resource):
         if full_tree():
             return self.get_full_tree(album)
 
-        return marshal(album, self.resource_fields)
+        return self.serializer(album)
 
     def get_many(self):
         artist_pk = request.args.get('artist')
@@ -193,9 +357,11 @@ class AlbumResource(Resource):
         else:
             albums = Album.query
 
-        queryset = albums.order_by(Album.year, Album.name, Album.pk)
-        for album in paginate(queryset):
-            yield marshal(album, self.resource_fields)
+        queryset = self.serializer.select(
+            albums, *self.sort_keys).order_by(*self.sort_keys)
+        albums, headers = paginate(queryset, self.sort_keys)
+
+        return list_response(albums, self.serializer, headers)
 
     def get_one(self, album_id):
         album = Album.query.get(album_id)
@@ -213,14 +379,24 @@ class AlbumResource(Resource):
 
         return album
 
-    def get_full_tree(self, album):
-        _album = marshal(album, self.resource_fields)
+    def get_full_tree(self, album, tracks=None):
+        """
+        Retrieves the album with all of its tracks. The caller can pass the
+        tracks, already loaded and sorted.
+
+        """
+
+        _album = self.serializer(album)
         _album['tracks'] = []
 
-        tracks = TracksResource()
+        if tracks is None:
+            tracks = prefetch(album.tracks.order_by('number', 'title').all(),
+                              TracksResource.resource_fields)
 
-        for track in album.tracks.order_by('number', 'title'):
-            _album['tracks'].append(tracks.get_full_tree(track))
+        _tracks = TracksResource()
+
+        for track in tracks:
+            _album['tracks'].append(_tracks.get_full_tree(track))
 
         return _album
 
@@ -233,6 +409,7 @@ class AlbumResource(Resource):
             return JSONResponse(404)
 
         g.db.session.delete(album)
+        bump_revision()
         g.db.session.commit()
 
         return {}
@@ -243,6 +420,8 @@ class TracksResource(Resource):
     """
 
     route_base = 'tracks'
+    method_decorators = [cached]
+    sort_keys = (Track.album_pk, Track.number, Track.pk)
     resource_fields = {
         'id': fields.Integer(attribute='pk'),
         'uri': InstanceURI('track'),
@@ -261,10 +440,11 @@ class TracksResource(Resource):
         }),
         'number': fields.Integer,
     }
+    serializer = Serializer(resource_fields, Track)
 
     def get(self, track_id=None, track_slug=None):
         if not track_id and not track_slug:
-            return list(self.get_many())
+            return self.get_many()
 
         if not track_id and track_slug:
             track = self.get_by_slug(track_slug)
@@ -274,9 +454,8 @@ class TracksResource(Resource):
         if full_tree():
             return self.get_full_tree(track, include_scraped=True)
 
-        return marshal(track, self.resource_fields)
+        return self.serializer(track)
 
-    # TODO: Pagination
     def get_many(self):
         album_pk = request.args.get('album')
         artist_pk = request.args.get('artist')
@@ -288,9 +467,11 @@ class TracksResource(Resource):
         else:
             tracks = Track.query
 
-        queryset = tracks.order_by(Track.album_pk, Track.number, Track.pk)
-        for track in paginate(queryset):
-            yield marshal(track, self.resource_fields)
+        queryset = self.serializer.select(
+            tracks, *self.sort_keys).order_by(*self.sort_keys)
+        tracks, headers = paginate(queryset, self.sort_keys)
+
+        return list_response(tracks, self.serializer, headers)
 
     def get_one(self, track_id):
         track = Track.query.get(track_id)
@@ -320,7 +501,7 @@ class TracksResource(Resource):
 
         """
 
-        _track = marshal(track, self.resource_fields)
+        _track = self.serializer(track)
 
         if include_scraped:
             lyrics = LyricsResource()
@@ -340,6 +521,7 @@ class TracksResource(Resource):
             return JSONResponse(404)
 
         g.db.session.delete(track)
+        bump_revision()
         g.db.session.commit()
 
         return {}
@@ -395,13 +577,15 @@ class LyricsResource(Resource):
         lyric = Lyrics(track=track, text=text)
 
         g.db.session.add(lyric)
-        g.db.commit()
+        bump_revision()
+        g.db.session.commit()
 
         return JSONResponse(200)
 
     def delete(self, track_id):
         track = Track.query.get(track_id)
         g.db.session.delete(track.lyrics)
+        bump_revision()
         g.db.session.commit()
 
         return JSONResponse(200)
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Transcodes tracks with an external encoder, ffmpeg by default, for clients
+that can't afford the original files. The output is streamed as the encoder
+produces it, and kept in a disk cache once finished: up to
+TRANSCODE_CACHE_SIZE bytes, evicting the least recently used renditions first.
+
+Requests for a rendition that's being encoded share the encoder. They read the
+partial file it's writing, waiting for more whenever they catch up.
+"""
+from collections import OrderedDict
+import errno
+import logging
+import os
+import subprocess
+import threading
+
+from flask import current_app as app
+
+logger = logging.getLogger(__name__)
+
+# Codec, container and mimetype of every output format.
+FORMATS = {
+    'mp3': ('libmp3lame', 'mp3', 'audio/mpeg'),
+    'ogg': ('libvorbis', 'ogg', 'audio/ogg'),
+}
+# Bytes read from the encoder or the partial file at a time.
+CHUNK_SIZE = 64 * 1024
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def get_command(encoder, source, format, bitrate, start=0):
+    codec, container, mimetype = FORMATS[format]
+    command = [encoder, '-nostdin', '-v', 'error']
+    if start:
+        command.extend(['-ss', '%.3f' % start])
+
+    return command + ['-i', source, '-vn', '-c:a', codec,
+                      '-b:a', '%ik' % bitrate, '-f', container, '-']
+
+
+class Encoding(object):
+    """
+    An encoder process writing a rendition to a partial file, renamed to its
+    final path once complete. Any number of readers can follow it with read().
+
+    """
+
+    def __init__(self, command, path, on_done):
+        self.path = path
+        self.partial = '%s.%i.part' % (path, os.getpid())
+        self.size = 0
+        self.done = self.failed = False
+        self.condition = threading.Condition()
+
+        try:
+            output = open(self.partial, 'wb')
+        except IOError, e:
+            raise TranscodeError('Could not write %s: %s' % (self.partial, e))
+
+        try:
+            with open(os.devnull, 'r+b') as devnull:
+                self.process = subprocess.Popen(
+                    command, stdin=devnull, stdout=subprocess.PIPE,
+                    stderr=devnull, close_fds=True)
+        except OSError, e:
+            output.close()
+            os.remove(self.partial)
+            raise TranscodeError('Could not run %s: %s' % (command[0], e))
+
+        thread = threading.Thread(target=self.pump, args=(output, on_done))
+        thread.daemon = True
+        thread.start()
+
+    def pump(self, output, on_done):
+        """Copies the encoder's output to the partial file."""
+
+        failed = False
+        try:
+            with output:
+                fd = self.process.stdout.fileno()
+                for chunk in iter(lambda: os.read(fd, CHUNK_SIZE), ''):
+                    output.write(chunk)
+                    output.flush()
+                    with self.condition:
+                        self.size += len(chunk)
+                        self.condition.notify_all()
+        except (IOError, OSError), e:
+            logger.error('Could not write %s: %s' % (self.partial, e))
+            failed = True
+            self.process.kill()
+        finally:
+            self.process.stdout.close()
+
+        if self.process.wait():
+            logger.error('Encoder failed for %s.' % self.path)
+            failed = True
+
+        with self.condition:
+            try:
+                if failed:
+                    os.remove(self.partial)
+                else:
+                    os.rename(self.partial, self.path)
+            except OSError, e:
+                logger.error('Could not store %s: %s' % (self.path, e))
+                failed = True
+            self.done, self.failed = True, failed
+            self.condition.notify_all()
+
+        on_done(self)
+
+    def read(self):
+        """Returns an iterator over the rendition from its beginning, that
+        follows the encoder until it's done. Waits for the first bytes, so
+        encoders failing right away raise TranscodeError.
+        """
+
+        with self.condition:
+            while not self.size and not self.done:
+                self.condition.wait()
+            if self.failed:
+                raise TranscodeError('Encoder failed for %s.' % self.path)
+
+            return self.follow(open(self.path if self.done else self.partial,
+                                    'rb'))
+
+    def follow(self, f):
+        with f:
+            position = 0
+            while True:
+                with self.condition:
+                    while position >= self.size and not self.done:
+                        self.condition.wait()
+                    size, done = self.size, self.done
+
+                while position < size:
+                    chunk = f.read(min(CHUNK_SIZE, size - position))
+                    if not chunk:
+                        break
+
+                    position += len(chunk)
+                    yield chunk
+
+                if done:
+                    return
+
+
+class TranscodeCache(object):
+    """
+    A directory of finished renditions, named after the track, bitrate and
+    format, keeping up to `size` bytes. The last modification time of every
+    file tells when it was last used, and survives restarts.
+
+    It's safe to share an instance between threads.
+
+    """
+
+    def __init__(self, path, size, encoder):
+        self.path = path
+        self.size = size
+        self.encoder = encoder
+        self.used = 0
+        # name: size, from the least to the most recently used.
+        self.entries = None
+        self.encodings = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.entries is not None:
+            return
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.part'):
+                continue
+
+            stat = os.stat(os.path.join(self.path, name))
+            files.append((stat.st_mtime, name, stat.st_size))
+
+        self.entries = OrderedDict()
+        for mtime, name, size in sorted(files):
+            self.use(name, size)
+
+    def use(self, name, size):
+        if name in self.entries:
+            self.used -= self.entries.pop(name)
+        self.entries[name] = size
+        self.used += size
+
+    def remove(self, name):
+        self.used -= self.entries.pop(name)
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def evict(self, keep=None):
+        """Removes the least recently used renditions, but `keep`, until the
+        cache fits in its size.
+        """
+
+        for name in list(self.entries):
+            if self.used <= self.size:
+                break
+
+            if name != keep:
+                self.remove(name)
+
+    def get(self, source, pk, format, bitrate, start=0):
+        """
+        Returns a (path, encoding) tuple: the path of the rendition when it's
+        cached, otherwise the Encoding producing it. Renditions starting at a
+        given second are cached apart, to the millisecond.
+
+        """
+
+        start = int(round(start * 1000))
+        if start:
+            name = '%i-%i-%i.%s' % (pk, bitrate, start, format)
+        else:
+            name = '%i-%i.%s' % (pk, bitrate, format)
+        path = os.path.join(self.path, name)
+        with self.lock:
+            self.load()
+            encoding = self.encodings.get(name)
+            if encoding:
+                return (None, encoding)
+
+            try:
+                stat = os.stat(path)
+                fresh = stat.st_mtime >= os.stat(source).st_mtime
+            except OSError:
+                stat, fresh = None, False
+
+            if fresh:
+                # Renditions written by other processes are adopted.
+                os.utime(path, None)
+                self.use(name, stat.st_size)
+                self.evict(keep=name)
+
+                return (path, None)
+
+            if name in self.entries:
+                self.remove(name)
+
+            command = get_command(self.encoder, source, format, bitrate,
+                                  start=start / 1000.0)
+            encoding = Encoding(command, path, self.finished)
+            self.encodings[name] = encoding
+
+            return (None, encoding)
+
+    def finished(self, encoding):
+        name = os.path.basename(encoding.path)
+        with self.lock:
+            del self.encodings[name]
+            if encoding.failed:
+                return
+
+            self.use(name, encoding.size)
+            try:
+                self.evict()
+            except OSError, e:
+                logger.error('Could not evict renditions: %s' % e)
+
+_cache = None
+
+
+def get_transcode_cache():
+    global _cache
+
+    if _cache is None:
+        _cache = TranscodeCache(app.config['TRANSCODE_CACHE_PATH'],
+                                app.config['TRANSCODE_CACHE_SIZE'],
+                                app.config['TRANSCODE_ENCODER'])
+
+    return _cache
@@ -6,6 +6,8 @@ from hashlib import md5
 
 import translitcodec
 
+from shiva.mpeg import MP3Info, MPEGError, fingerprint
+
 PUNCT_RE = re.compile(r'[\t !"#$%&\'()*\-/<=>?@\[\\\]^_`{|},.]+')
 
 
@@ -14,7 +16,8 @@ def slugify(text):
     if not text:
         return ''
     result = []
-    text = text.decode('utf-8')
+    if isinstance(text, str):
+        text = text.decode('utf-8')
     for word in PUNCT_RE.split(text.lower()):
         word = word.encode('translit/long')
         if word:
@@ -46,6 +49,10 @@ def _import(class_path):
 
 
 class ID3Manager(object):
+    """Reads and edits the ID3 tag of a file. Nothing is written until save()
+    is called, so several changes cost a single rewrite of the file.
+    """
+
     def __init__(self, mp3_path):
         import eyed3  # FIXME: Replace ASAP
 
@@ -54,7 +61,6 @@ class ID3Manager(object):
 
         if not self.reader.tag:
             self.reader.tag = eyed3.id3.Tag()
-            self.reader.tag.save(mp3_path)
 
     def __getattribute__(self, attr):
         _super = super(ID3Manager, self)
@@ -88,26 +94,23 @@ class ID3Manager(object):
         return path == self.mp3_path
 
     def get_artist(self):
-        return self.reader.tag.artist.strip()
+        return (self.reader.tag.artist or u'').strip()
 
     def set_artist(self, name):
         self.reader.tag.artist = name
-        self.reader.tag.save()
 
     def get_album(self):
-        return self.reader.tag.album.strip()
+        return (self.reader.tag.album or u'').strip()
 
     def set_album(self, name):
         self.reader.tag.album = name
-        self.reader.tag.save()
 
     def get_release_year(self):
         rdate = self.reader.tag.release_date
         return rdate.year if rdate else None
 
     def set_release_year(self, year):
-        self.release_date.year = year
-        self.reader.tag.save()
+        self.reader.tag.release_date = year
 
     def get_bitrate(self):
         return self.reader.info.bit_rate[1]
@@ -119,14 +122,70 @@ class ID3Manager(object):
         return self.reader.tag.track_num[0]
 
     def get_title(self):
-        if not self.reader.tag.title:
-            _title = raw_input('Song title: ').decode('utf-8').strip()
-            self.reader.tag.title = _title
-            self.reader.tag.save()
+        return (self.reader.tag.title or u'').strip()
+
+    def set_title(self, title):
+        self.reader.tag.title = title
 
-        return self.reader.tag.title
+    def save(self):
+        """Writes the changes to the file."""
+        self.reader.tag.save(self.mp3_path)
 
     def get_size(self):
         """Computes the size of the mp3 file in filesystem.
         """
         return os.stat(self.reader.path).st_size
+
+
+class TrackInfo(object):
+    """A picklable snapshot of the metadata an ID3Manager exposes. This is
+    what the indexer's worker processes hand over to the writer, so it can
+    stand in for an ID3Manager wherever only reading is needed.
+    """
+
+    def __init__(self, path, artist=None, album=None, title=None,
+                 release_year=None, bitrate=None, length=None,
+                 track_number=None, size=None, fingerprint=None,
+                 seek_table=None):
+        self.path = path
+        self.artist = artist
+        self.album = album
+        self.title = title
+        self.release_year = release_year
+        self.bitrate = bitrate
+        self.length = length
+        self.track_number = track_number
+        self.size = size
+        self.fingerprint = fingerprint
+        self.seek_table = seek_table
+
+    @classmethod
+    def load(cls, path):
+        """Reads a file with the fast MP3Info reader, falling back to eyed3
+        for the files it can't handle.
+        """
+        try:
+            return cls.from_reader(MP3Info(path))
+        except MPEGError:
+            info = cls.from_reader(ID3Manager(path))
+            # The audio frames weren't found, so the tags are hashed too.
+            with open(path, 'rb') as f:
+                info.fingerprint = fingerprint(f, 0, os.fstat(
+                    f.fileno()).st_size)
+
+            return info
+
+    @classmethod
+    def from_reader(cls, id3r):
+        return cls(id3r.path, artist=id3r.artist, album=id3r.album,
+                   title=id3r.title, release_year=id3r.release_year,
+                   bitrate=id3r.bitrate, length=id3r.length,
+                   track_number=id3r.track_number, size=id3r.size,
+                   fingerprint=getattr(id3r, 'fingerprint', None),
+                   seek_table=getattr(id3r, 'seek_table', None))
+
+    def same_path(self, path):
+        return path == self.path
+
+    def is_valid(self):
+        return bool(self.path)
@@ -1,20 +1,401 @@
 # -*- coding: utf-8 -*-
-from flask import Response
+"""
+Track downloads. Files are sent from disk a chunk at a time, or through the
+server's wsgi.file_wrapper (sendfile) when sent whole, so a download takes
+the same memory however big the file is. Single and multiple byte ranges are
+supported, as well as conditional requests.
+
+The *t* parameter starts the file at the frame playing at that second, found
+in the track's seek table. It then behaves as if the file started there.
+Transcoded streams start there too, the encoder skips what comes before.
+
+With DOWNLOAD_OFFLOAD set a front proxy sends the bytes instead, and the
+response only tells it which file to send.
+
+Tracks can also be streamed transcoded, see shiva.transcode. Albums and
+artists are downloaded as ZIP archives, see shiva.archive.
+"""
+import calendar
+from datetime import datetime
+import logging
+import os
+import re
+import urllib
+import uuid
+
+from flask import Response, current_app as app, request
+from werkzeug.http import (http_date, is_resource_modified, parse_date,
+                           quote_etag)
+from werkzeug.wsgi import ClosingIterator, wrap_file
 
 from shiva import models
+from shiva.archive import FILE_SIZE_LIMIT, Archive
+from shiva.mpeg import seek
+from shiva.transcode import FORMATS, TranscodeError, get_transcode_cache
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from the file at a time.
+CHUNK_SIZE = 64 * 1024
+# Requests asking for more ranges than this get the whole file.
+MAX_RANGES = 16
+# Characters left out of the names of archived files.
+CONTROL_RE = re.compile(u'[\x00-\x1f\x7f]')
+
+
+def read_range(track_file, start, stop):
+    track_file.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        chunk = track_file.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+
+        remaining -= len(chunk)
+        yield chunk
+
+
+def get_ranges(size, etag, mtime):
+    """
+    Returns the (start, stop) byte ranges requested, an empty list when none
+    of them can be satisfied, or None when the whole file has to be sent:
+    no Range header, or an If-Range the file doesn't match anymore.
+
+    """
+
+    _range = request.range
+    if _range is None or _range.units != 'bytes' or \
+            len(_range.ranges) > MAX_RANGES:
+        return None
+
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        if if_range.startswith(('"', 'W/')):
+            # Only strong validators match.
+            if if_range != etag:
+                return None
+        else:
+            date = parse_date(if_range)
+            if not date or calendar.timegm(date.timetuple()) != mtime:
+                return None
+
+    ranges = []
+    for start, stop in _range.ranges:
+        if start < 0:
+            # The last -start bytes.
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+
+        if start < stop:
+            ranges.append((start, stop))
+
+    return ranges
+
+
+def get_seconds():
+    """Returns the second given in the *t* parameter, 0 without one, or None
+    if it isn't valid.
+    """
+
+    try:
+        seconds = float(request.args.get('t', 0))
+    except ValueError:
+        return None
+
+    if not 0 <= seconds < float('inf'):
+        return None
+
+    return seconds
+
+
+def send_file(path, mimetype, headers, offset=0):
+    """
+    Sends a file, or the byte ranges of it that were asked for, as if it
+    started at the given offset. Answers conditional requests, and lets the
+    front proxy send it when DOWNLOAD_OFFLOAD is set.
+
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return Response('', status=404)
+
+    size, mtime = stat.st_size - offset, int(stat.st_mtime)
+    etag = '%x-%x-%x' % (stat.st_ino, stat.st_size, mtime)
+    etag = quote_etag('%s-%x' % (etag, offset) if offset else etag)
+    headers = headers + [
+        ('ETag', etag),
+        ('Last-Modified', http_date(mtime)),
+        ('Accept-Ranges', 'bytes'),
+    ]
+
+    last_modified = datetime.utcfromtimestamp(mtime)
+    if not is_resource_modified(request.environ, etag,
+                                last_modified=last_modified):
+        return Response(status=304, headers=headers)
+
+    # The proxy can't start the file at an offset.
+    offload = app.config.get('DOWNLOAD_OFFLOAD') if not offset else None
+    if offload == 'X-Sendfile':
+        headers.append(('X-Sendfile', path))
+    elif offload == 'X-Accel-Redirect':
+        uri = app.config.get('DOWNLOAD_ACCEL_PREFIX', '') + path
+        headers.append(('X-Accel-Redirect', urllib.quote(uri)))
+    if offload:
+        # The proxy handles the ranges.
+        return Response('', mimetype=mimetype, headers=headers)
+
+    ranges = get_ranges(size, etag, mtime)
+    if ranges == []:
+        headers.append(('Content-Range', 'bytes */%i' % size))
+
+        return Response('', status=416, headers=headers)
+
+    content_type = mimetype
+    if ranges is None:
+        status, length = 200, size
+    elif len(ranges) == 1:
+        (start, stop), = ranges
+        status, length = 206, stop - start
+        headers.append(('Content-Range',
+                        'bytes %i-%i/%i' % (start, stop - 1, size)))
+    else:
+        boundary = uuid.uuid4().hex
+        content_type = 'multipart/byteranges; boundary=%s' % boundary
+        parts = [('%s--%s\r\nContent-Type: %s\r\n'
+                  'Content-Range: bytes %i-%i/%i\r\n\r\n' % (
+                      '\r\n' if i else '', boundary, mimetype, start,
+                      stop - 1, size),
+                  start, stop) for i, (start, stop) in enumerate(ranges)]
+        end = '\r\n--%s--\r\n' % boundary
+        status = 206
+        length = sum(len(head) + stop - start for head, start, stop in parts)
+        length += len(end)
+
+    if request.method == 'HEAD':
+        body = ()
+    else:
+        _file = open(path, 'rb')
+        if ranges is None:
+            _file.seek(offset)
+            body = wrap_file(request.environ, _file, CHUNK_SIZE)
+        elif len(ranges) == 1:
+            body = ClosingIterator(
+                read_range(_file, offset + start, offset + stop), _file.close)
+        else:
+            def _multipart():
+                for head, start, stop in parts:
+                    yield head
+                    for chunk in read_range(_file, offset + start,
+                                            offset + stop):
+                        yield chunk
+                yield end
+
+            body = ClosingIterator(_multipart(), _file.close)
+
+    response = Response(body, status=status, mimetype=content_type,
+                        headers=headers, direct_passthrough=True)
+    response.content_length = length
+
+    return response
 
 
 def download(track_id, ext):
     """
+    Sends the file of a track, from the second given in *t* if any.
+
     """
+
     if ext != 'mp3':
         return Response('', status=404)
 
     track = models.Track.query.get(track_id)
-    track_file = open(track.get_path(), 'r')
-    filename_header = (
-        'Content-Disposition', 'attachment; filename="%s.mp3"' % track.title
-    )
+    if not track or not track.path:
+        return Response('', status=404)
+
+    seconds = get_seconds()
+    if seconds is None:
+        return Response('', status=400)
+
+    path = track.get_path()
+    offset = 0
+    if seconds:
+        try:
+            table = track.get_seek_table()
+            if table:
+                with open(path, 'rb') as track_file:
+                    offset = seek(table, seconds, track_file) or 0
+        except IOError:
+            return Response('', status=404)
+
+    headers = [
+        ('Content-Disposition', get_disposition(u'%s.mp3' % track.title)),
+    ]
+
+    return send_file(path, 'audio/mpeg', headers, offset=offset)
+
+
+def stream(track_id):
+    """
+    Sends a track transcoded to the *format* and *bitrate* asked for, from
+    the second given in *t* if any. Cached renditions are sent as files,
+    otherwise the encoder's output is streamed as it's produced.
+
+    """
+
+    _format = request.args.get('format', 'mp3')
+    try:
+        bitrate = int(request.args.get('bitrate', 0))
+    except ValueError:
+        bitrate = 0
+    seconds = get_seconds()
+    if _format not in FORMATS or seconds is None or \
+            bitrate not in app.config['TRANSCODE_BITRATES']:
+        return Response('', status=400)
+
+    track = models.Track.query.get(track_id)
+    if not track or not track.path:
+        return Response('', status=404)
+
+    mimetype = FORMATS[_format][2]
+    if request.method == 'HEAD':
+        # Without starting an encoder. The length isn't known beforehand.
+        return Response(iter(()), mimetype=mimetype)
+
+    try:
+        path, encoding = get_transcode_cache().get(
+            track.get_path(), track.pk, _format, bitrate, start=seconds)
+        if path:
+            return send_file(path, mimetype, [])
+
+        return Response(encoding.read(), mimetype=mimetype,
+                        direct_passthrough=True)
+    except (IOError, OSError, TranscodeError), e:
+        logger.error('Could not transcode track %i: %s' % (track.pk, e))
+
+        return Response('', status=503)
+
+
+def get_file_name(name):
+    """Turns a name into something that can be used as a file name. It can't
+    be a path, hidden, nor '.' or '..'.
+    """
+
+    name = CONTROL_RE.sub(u'', name).replace(u'/', u'-').replace(u'\\', u'-')
+
+    return name.strip().lstrip(u'.').strip() or u'_'
+
+
+def get_disposition(name):
+    """Returns the Content-Disposition of a download saved with the given
+    name. Names that aren't plain ASCII are sent in filename* as RFC 5987
+    asks, with an ASCII approximation in filename for older clients.
+    """
+
+    name = get_file_name(name)
+    fallback = ''.join(char if u' ' <= char < u'\x7f' and char != u'"' else '_'
+                       for char in name)
+    value = 'attachment; filename="%s"' % fallback
+    if fallback != name:
+        value += "; filename*=UTF-8''%s" % urllib.quote(name.encode('utf-8'),
+                                                         safe='')
+
+    return value
+
+
+def send_archive(name, tracks):
+    """
+    Sends a ZIP archive of tracks, given as (path, title, number, directory)
+    tuples, inside a directory with the given name. Tracks whose file is
+    missing, or too big to be archived, are left out.
+
+    """
+
+    files = []
+    names = set()
+    for path, title, number, directory in tracks:
+        path = path.encode('utf-8')
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+
+        if stat.st_size >= FILE_SIZE_LIMIT:
+            logger.warning('%s is too big to be archived.' % path)
+            continue
+
+        title = title or os.path.splitext(os.path.basename(
+            path))[0].decode('utf-8', 'replace')
+        title = get_file_name(title)
+        if number:
+            title = u'%02i - %s' % (number, title)
+        parts = [get_file_name(name)]
+        if directory:
+            parts.append(get_file_name(directory))
+        file_name = u'/'.join(parts + [title])
+
+        i = 1
+        while (u'%s.mp3' % file_name).lower() in names:
+            i += 1
+            file_name = u'/'.join(parts + [u'%s (%i)' % (title, i)])
+        file_name = u'%s.mp3' % file_name
+        names.add(file_name.lower())
+
+        files.append((file_name, path, stat.st_size, stat.st_mtime))
+
+    archive = Archive(files)
+    body = () if request.method == 'HEAD' else archive
+    response = Response(body, mimetype='application/zip',
+                        direct_passthrough=True)
+    response.content_length = archive.size
+
+    return response
+
+
+def download_album(album_id, ext):
+    """
+    Sends all the tracks of an album in a ZIP archive.
+
+    """
+
+    album = models.Album.query.get(album_id)
+    if ext not in ('mp3', 'zip') or not album:
+        return Response('', status=404)
+
+    Track = models.Track
+    query = models.db.session.query(
+        Track.path, Track.title, Track.number).filter(
+        Track.album_pk == album.pk).order_by(Track.number, Track.title)
+    tracks = ((path, title, number, None) for path, title, number in query)
+
+    response = send_archive(album.name, tracks)
+    response.headers['Content-Disposition'] = get_disposition(
+        u'%s.zip' % album.slug)
+
+    return response
+
+
+def download_artist(artist_id, ext):
+    """
+    Sends all the tracks of an artist in a ZIP archive, in a directory per
+    album.
+
+    """
+
+    artist = models.Artist.query.get(artist_id)
+    if ext not in ('mp3', 'zip') or not artist:
+        return Response('', status=404)
+
+    Track, Album = models.Track, models.Album
+    tracks = models.db.session.query(
+        Track.path, Track.title, Track.number, Album.name).outerjoin(
+        Track.album).filter(Track.artist_pk == artist.pk).order_by(
+        Album.year, Album.name, Track.album_pk, Track.number, Track.title)
+
+    response = send_archive(artist.name, tracks)
+    response.headers['Content-Disposition'] = get_disposition(
+        u'%s.zip' % artist.slug)
 
-    return Response(response=track_file.read(), mimetype='audio/mpeg',
-                    headers=[filename_header])
+    return response
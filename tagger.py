@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Writes the tag edits queued by the indexer and the resolver to the files. All
+the edits of a file are written at once, e.g.:
+
+    $ python tagger.py --list
+    $ python tagger.py --jobs 4
+"""
+import argparse
+import logging
+import multiprocessing
+
+from shiva import models as m
+from shiva.app import db
+from shiva.utils import ID3Manager
+
+logger = logging.getLogger()
+
+# Maximum number of bound parameters in a single IN clause.
+IN_CLAUSE_SIZE = 500
+
+
+def write_tags(edit):
+    """Worker entry point. Applies every change to a file's tags and saves
+    it once. Returns the path and whether it succeeded.
+    """
+
+    path, values = edit
+    try:
+        tags = ID3Manager(path)
+        for field, value in values.iteritems():
+            setattr(tags, field, value)
+        tags.save()
+    except Exception, e:
+        logger.error('Could not write the tags of %s: %s' % (path, e))
+
+        return (path, False)
+
+    return (path, True)
+
+
+def get_edits():
+    """Returns the queued edits as a {path: {field: value}} dictionary."""
+
+    edits = {}
+    for edit in m.TagEdit.query.order_by(m.TagEdit.pk):
+        edits.setdefault(edit.path, {})[edit.field] = edit.value
+
+    return edits
+
+
+def apply_edits(jobs=1):
+    edits = [(path.encode('utf-8'), values)
+             for path, values in get_edits().iteritems()]
+
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(write_tags, edits)
+    else:
+        results = (write_tags(edit) for edit in edits)
+
+    done = []
+    try:
+        for path, success in results:
+            if success:
+                logger.debug(path)
+                done.append(path.decode('utf-8'))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    for i in xrange(0, len(done), IN_CLAUSE_SIZE):
+        paths = done[i:i + IN_CLAUSE_SIZE]
+        m.TagEdit.query.filter(m.TagEdit.path.in_(paths)).delete(
+            synchronize_session=False)
+    db.session.commit()
+
+    return len(done)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Writes the queued tag edits to the files.')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='List the queued edits.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes writing in parallel.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every file written.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.list:
+        for path, values in sorted(get_edits().iteritems()):
+            print path.encode('utf-8')
+            for field, value in sorted(values.iteritems()):
+                print '    %s: %s' % (field, value.encode('utf-8'))
+    else:
+        count = apply_edits(jobs=args.jobs)
+        logger.info('%i files written.' % count)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the API's response cache serves the same response on a miss and on a
+hit, and revalidates it.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from shiva import cache
+from shiva import models as m
+from shiva.app import app, db
+
+
+class CachedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = dict((key, app.config[key]) for key in (
+            'SQLALCHEMY_DATABASE_URI', 'RESPONSE_CACHE_SIZE'))
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % (
+            os.path.join(self.dir, 'shiva.db'))
+        app.config['RESPONSE_CACHE_SIZE'] = 1024 * 1024
+        db.create_all()
+        m.slugs.clear()
+
+        db.session.add(m.Artist(name='Bad Religion'))
+        db.session.commit()
+
+        cache._cache = None
+        self.client = app.test_client()
+
+    def tearDown(self):
+        cache._cache = None
+        db.session.remove()
+        db.get_engine(app).dispose()
+        app.config.update(self.config)
+        shutil.rmtree(self.dir)
+
+    def test_content_type(self):
+        miss = self.client.get('/artist/1')
+        self.assertEqual(miss.status_code, 200)
+        self.assertEqual(miss.mimetype, 'application/json')
+        self.assertEqual(len(cache.get_cache().entries), 1)
+
+        hit = self.client.get('/artist/1')
+        self.assertEqual(hit.status_code, 200)
+        self.assertEqual(hit.mimetype, 'application/json')
+        self.assertEqual(hit.headers.getlist('Content-Type'),
+                         ['application/json'])
+        self.assertEqual(hit.data, miss.data)
+        self.assertEqual(hit.headers['ETag'], miss.headers['ETag'])
+
+        # Listings are streamed, and never cached.
+        listing = self.client.get('/artists')
+        self.assertEqual(listing.mimetype, 'application/json')
+        self.assertEqual(len(cache.get_cache().entries), 1)
+
+    def test_not_modified(self):
+        etag = self.client.get('/artist/1').headers['ETag']
+        response = self.client.get('/artist/1',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+
+if __name__ == '__main__':
+    unittest.main()
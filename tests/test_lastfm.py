@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the Last.fm client, its cache and the indexer's enrichment stage against
+a local server replaying canned Last.fm responses.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+
+from shiva import models as m
+from shiva.app import app, db
+from shiva.lastfm import LastFM, ResponseCache
+
+# (method, artist, album): response. Anything else gets Last.fm's error.
+RESPONSES = {
+    ('artist.getinfo', 'Bad Religion', None): {'artist': {'image': [
+        {'size': 'large', '#text': 'http://img/br-large.png'},
+        {'size': 'mega', '#text': 'http://img/br-mega.png'},
+    ]}},
+    ('artist.getinfo', 'NOFX', None): {'artist': {'image': [
+        {'size': 'mega', '#text': 'http://img/nofx-mega.png'},
+    ]}},
+    ('album.getinfo', 'Bad Religion', 'Suffer'): {'album': {
+        'releasedate': '    8 Sep 1988, 00:00',
+        'image': [{'size': 'extralarge', '#text': 'http://img/suffer.png'}],
+    }},
+    ('album.getinfo', 'NOFX', 'Punk in Drublic'): {'album': {
+        'releasedate': '19 Jul 1994, 00:00',
+        'image': [{'size': 'extralarge', '#text': 'http://img/pid.png'}],
+    }},
+}
+NOT_FOUND = {'error': 6, 'message': 'The artist you supplied could not be '
+                                    'found'}
+RATE_LIMITED = {'error': 29, 'message': 'Rate limit exceeded'}
+# Seconds every response takes, so the enrichment workers overlap.
+DELAY = 0.1
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.active = self.max_active = 0
+        self.fail = False
+        # A Last.fm error answered instead of the canned responses.
+        self.error = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%i/2.0/' % self.server_port
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+            self.max_active = 0
+            self.fail = False
+            self.error = None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        params = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        with server.lock:
+            server.requests.append(params)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+
+        time.sleep(DELAY)
+        if server.fail:
+            status, body = 500, 'Internal Server Error'
+        elif server.error:
+            status, body = 200, json.dumps(server.error)
+        else:
+            key = (params.get('method'), params.get('artist'),
+                   params.get('album'))
+            status, body = 200, json.dumps(RESPONSES.get(key, NOT_FOUND))
+
+        with server.lock:
+            server.active -= 1
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def setUpModule():
+    global server
+
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def tearDownModule():
+    server.shutdown()
+    server.server_close()
+
+
+class LastFMTestCase(unittest.TestCase):
+
+    def setUp(self):
+        server.reset()
+        self.dir = tempfile.mkdtemp()
+        self.cache = ResponseCache(os.path.join(self.dir, 'lastfm.db'),
+                                   ttl=60, miss_ttl=10)
+        self.lastfm = LastFM('key', url=server.url, cache=self.cache)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
+
+    def age(self, seconds):
+        """Makes every cached response `seconds` older."""
+
+        with self.cache.lock:
+            self.cache.conn.execute('UPDATE responses '
+                                    'SET fetched = fetched - ?', (seconds,))
+            self.cache.conn.commit()
+
+    def test_cache_hit(self):
+        image = 'http://img/br-mega.png'
+        self.assertEqual(self.lastfm.get_artist_image(u'Bad Religion'), image)
+        self.assertEqual(self.lastfm.get_artist_image(u'Bad Religion'), image)
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(server.requests[0]['api_key'], 'key')
+
+        # Other clients sharing the file get the cached response too.
+        lastfm = LastFM('key', url=server.url, cache=self.cache)
+        self.assertEqual(lastfm.get_artist_image(u'Bad Religion'), image)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_cache_miss(self):
+        self.assertEqual(self.lastfm.get_album_info(u'Anti-Flag', u'Die for '
+                                                    u'the Government'),
+                         (None, None))
+        self.assertEqual(self.lastfm.get_album_info(u'Anti-Flag', u'Die for '
+                                                    u'the Government'),
+                         (None, None))
+        self.assertEqual(len(server.requests), 1)
+
+    def test_ttl(self):
+        self.lastfm.get_artist_image(u'NOFX')
+        self.lastfm.get_artist_image(u'Anti-Flag')
+        self.assertEqual(len(server.requests), 2)
+
+        # Misses expire first.
+        self.age(30)
+        self.lastfm.get_artist_image(u'NOFX')
+        self.lastfm.get_artist_image(u'Anti-Flag')
+        self.assertEqual([r['artist'] for r in server.requests[2:]],
+                         ['Anti-Flag'])
+
+        self.age(61)
+        self.assertEqual(self.lastfm.get_artist_image(u'NOFX'),
+                         'http://img/nofx-mega.png')
+        self.assertEqual([r['artist'] for r in server.requests[3:]],
+                         ['NOFX'])
+
+    def test_errors_not_cached(self):
+        server.fail = True
+        self.assertEqual(self.lastfm.get_artist_image(u'NOFX'), None)
+
+        server.fail = False
+        self.assertEqual(self.lastfm.get_artist_image(u'NOFX'),
+                         'http://img/nofx-mega.png')
+        self.assertEqual(len(server.requests), 2)
+
+    def test_rate_limit_not_cached(self):
+        server.error = RATE_LIMITED
+        self.assertEqual(self.lastfm.get_artist_image(u'NOFX'), None)
+        self.assertEqual(self.lastfm.get_artist_image(u'NOFX'), None)
+        self.assertEqual(len(server.requests), 2)
+
+        server.error = None
+        self.assertEqual(self.lastfm.get_artist_image(u'NOFX'),
+                         'http://img/nofx-mega.png')
+        self.assertEqual(len(server.requests), 3)
+
+
+class EnrichTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from indexer import Indexer
+
+        server.reset()
+        self.dir = tempfile.mkdtemp()
+        self.config = dict(app.config, LASTFM_API_KEY='key',
+                           LASTFM_API_URL=server.url, LASTFM_WORKERS=4,
+                           LASTFM_CACHE_PATH=os.path.join(self.dir,
+                                                          'lastfm.db'))
+        self.database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % (
+            os.path.join(self.dir, 'shiva.db'))
+        db.create_all()
+        m.slugs.clear()
+
+        albums = (('Bad Religion', 'Suffer'), ('NOFX', 'Punk in Drublic'),
+                  ('Anti-Flag', 'Die for the Government'))
+        for artist_name, album_name in albums:
+            artist = m.Artist(name=artist_name)
+            album = m.Album(name=album_name)
+            album.artists.append(artist)
+            db.session.add(album)
+        db.session.commit()
+
+        self.indexer = Indexer(self.config)
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(app).dispose()
+        app.config['SQLALCHEMY_DATABASE_URI'] = self.database_uri
+        shutil.rmtree(self.dir)
+
+    def test_enrich(self):
+        self.assertTrue(self.indexer.enrich())
+        self.assertEqual(self.indexer.metrics.get('enriched'), 4)
+        self.assertEqual(len(server.requests), 6)
+        self.assertTrue(server.max_active > 1)
+
+        suffer = m.Album.query.filter_by(name='Suffer').one()
+        self.assertEqual((suffer.cover, suffer.year),
+                         ('http://img/suffer.png', 1988))
+        nofx = m.Artist.query.filter_by(name='NOFX').one()
+        self.assertEqual(nofx.image, 'http://img/nofx-mega.png')
+        anti_flag = m.Artist.query.filter_by(name='Anti-Flag').one()
+        self.assertEqual(anti_flag.image, None)
+
+        # Only Anti-Flag is still missing, and Last.fm's answer is cached.
+        self.assertTrue(self.indexer.enrich())
+        self.assertEqual(self.indexer.metrics.get('enriched'), 4)
+        self.assertEqual(len(server.requests), 6)
+
+    def test_enrich_changed_only(self):
+        # As after watch mode saves a track of NOFX's Punk in Drublic.
+        nofx = m.Artist.query.filter_by(name='NOFX').one()
+        self.indexer.changed_artists.add(nofx.pk)
+        self.indexer.changed_albums.update(album.pk for album in nofx.albums)
+
+        self.assertTrue(self.indexer.enrich(changed_only=True))
+        self.assertEqual(self.indexer.metrics.get('enriched'), 2)
+        self.assertEqual(sorted((r['method'], r['artist'])
+                                for r in server.requests),
+                         [('album.getinfo', 'NOFX'),
+                          ('artist.getinfo', 'NOFX')])
+        suffer = m.Album.query.filter_by(name='Suffer').one()
+        self.assertEqual(suffer.cover, None)
+
+        # Nothing changed since.
+        self.assertTrue(self.indexer.enrich(changed_only=True))
+        self.assertEqual(len(server.requests), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
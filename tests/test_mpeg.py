@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Compares what the MP3 reader gets out of the fixtures with what eyed3 does.
+
+The fixtures are short MPEG streams with silent frames: ID3v2.3 with a
+picture, ID3v2.4 in UTF-16, ID3v1 only, Xing VBR, MPEG-2, and two files whose
+Xing and VBRI headers are cut short.
+"""
+import os
+import unittest
+
+from shiva.mpeg import MP3Info, MPEGError
+from shiva.utils import ID3Manager, TrackInfo
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+FIELDS = ('artist', 'album', 'title', 'track_number', 'release_year',
+          'bitrate', 'length', 'size')
+
+
+def fixture(name):
+    return os.path.join(FIXTURES, name)
+
+
+class MP3InfoTestCase(unittest.TestCase):
+
+    def assertSameAsEyed3(self, name):
+        info = MP3Info(fixture(name))
+        expected = TrackInfo.from_reader(ID3Manager(fixture(name)))
+        for field in FIELDS:
+            self.assertEqual(getattr(info, field), getattr(expected, field),
+                             '%s: %s' % (name, field))
+
+    def test_id3v23(self):
+        self.assertSameAsEyed3('id3v23.mp3')
+
+    def test_id3v24_utf16(self):
+        self.assertSameAsEyed3('id3v24_utf16.mp3')
+
+        info = MP3Info(fixture('id3v24_utf16.mp3'))
+        self.assertEqual((info.artist, info.album, info.title),
+                         (u'Motörhead', u'Ace of Spädes', u'テスト'))
+
+    def test_id3v1(self):
+        self.assertSameAsEyed3('id3v1.mp3')
+
+    def test_xing(self):
+        self.assertSameAsEyed3('xing_vbr.mp3')
+
+        info = MP3Info(fixture('xing_vbr.mp3'))
+        self.assertTrue(info.vbr)
+        self.assertEqual(info.frames, 100)
+
+    def test_mpeg2(self):
+        self.assertSameAsEyed3('mpeg2.mp3')
+
+    def test_truncated(self):
+        for name in ('truncated_xing.mp3', 'truncated_vbri.mp3'):
+            self.assertRaises(MPEGError, MP3Info, fixture(name))
+
+            # TrackInfo falls back to eyed3.
+            info = TrackInfo.load(fixture(name))
+            self.assertEqual(info.path, fixture(name))
+            self.assertEqual(info.size, os.path.getsize(fixture(name)))
+
+
+if __name__ == '__main__':
+    unittest.main()